@@ -0,0 +1,76 @@
+# Decode cost of one 200 message page (the size get_all_messages asks for) with each installed JSON backend.
+#
+#   python benchmarks/bench_json.py [--messages 200] [--iterations 2000] [--json]
+import argparse
+import json
+import os
+import sys
+import timeit
+
+# Run as a script from a checkout, the package is in the directory above this one (also for run.py's child processes)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reddit_chat_archiver import jsonlib  # pylint: disable=wrong-import-position
+
+
+def make_page(count):
+    messages = []
+    for i in range(count):
+        messages.append(
+            {
+                "type": "MESG",
+                "message_id": 1600000000 + i,
+                "channel_url": "sendbird_group_channel_123456789_0123456789abcdef0123456789abcdef01234567",
+                "created_at": 1600000000000 + i * 1000,
+                "updated_at": 0,
+                "message": "message number %d, with some unicode éè and a bit of text to make it realistic" % i,
+                "data": "",
+                "custom_type": "",
+                "mention_type": "users",
+                "mentioned_users": [],
+                "is_removed": False,
+                "user": {
+                    "user_id": "t2_%08x" % (i % 7),
+                    "nickname": "user%d" % (i % 7),
+                    "profile_url": "https://www.redditstatic.com/avatars/avatar_default_%02d.png" % (i % 20),
+                    "metadata": {},
+                },
+                "translations": {},
+                "message_survival_seconds": -1,
+            }
+        )
+    return json.dumps({"messages": messages}).encode()
+
+
+def bench(name, page, iterations):
+    loads, _ = jsonlib.load_backend(name)
+    assert loads(page) == json.loads(page)
+    seconds = min(timeit.repeat(lambda: loads(page), number=iterations, repeat=3)) / iterations
+    return {"backend": name, "us_per_page": seconds * 1e6, "mb_per_s": len(page) / seconds / 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--json", action="store_true", help="Print machine readable results")
+    args = parser.parse_args()
+
+    page = make_page(args.messages)
+    results = []
+    for name in jsonlib.BACKENDS:
+        try:
+            results.append(bench(name, page, args.iterations))
+        except ImportError:
+            continue
+    if args.json:
+        json.dump({"page_bytes": len(page), "default": jsonlib.BACKEND, "results": results}, sys.stdout, indent=1)
+        print()
+        return
+    print("%d messages, %d bytes per page (default backend: %s)" % (args.messages, len(page), jsonlib.BACKEND))
+    for result in results:
+        print("%-10s %10.1f us/page %8.1f MB/s" % (result["backend"], result["us_per_page"], result["mb_per_s"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+# Throughput and peak memory of the archiver against the local fake server (reddit_chat_archiver.fake_server).
+#
+#   python benchmarks/run.py [--only messages,frames] [--repeat 3] [--output results.json]
+#   python benchmarks/run.py --baseline results.json [--threshold 0.15]
+#
+# Each benchmark runs in its own process, so peak_rss_kb is that benchmark's alone; the fake server runs in this one.
+# With --baseline, any *_per_s result more than --threshold below the baseline, or peak_rss_kb more than --threshold above
+# it, is reported as a regression and the exit status is 1.
+import argparse
+import importlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Run as a script from a checkout, the package is in the directory above this one (also for run.py's child processes)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reddit_chat_archiver import endpoints, fake_server, jsonlib  # pylint: disable=wrong-import-position
+
+import bench_json  # pylint: disable=wrong-import-position
+
+BENCHMARKS = ["channels", "messages", "messages_sharded", "messages_asyncio", "frames", "frames_archived", "json_decode"]
+DEFAULT_THRESHOLD = 0.15
+
+
+class NullSink(object):
+    def write_channels(self, all_channels):
+        pass
+
+    def start_channel(self, channel_url, append=False):
+        pass
+
+    def write_page(self, channel_url, messages):
+        pass
+
+    def finish_channel(self, channel_url):
+        pass
+
+    def close(self):
+        pass
+
+
+def archiver():
+    return importlib.import_module("reddit_chat_archiver.reddit_chat_archiver")
+
+
+def bench_channels(args):
+    rca = archiver()
+    session = rca.ArchiverSession("bench")
+    started = time.perf_counter()
+    channels = rca.get_all_channels("bench", session)
+    seconds = time.perf_counter() - started
+    assert len(channels) == args.channels
+    return {"channels": len(channels), "seconds": seconds, "channels_per_s": len(channels) / seconds}
+
+
+def _messages_result(count, pages, seconds):
+    return {
+        "messages": count,
+        "pages": pages,
+        "seconds": seconds,
+        "messages_per_s": count / seconds,
+        "pages_per_s": pages / seconds,
+    }
+
+
+def bench_messages(args, shards=1):
+    rca = archiver()
+    session = rca.ArchiverSession("bench", pool_size=max(rca.DEFAULT_POOL_SIZE, shards))
+    channel_url = fake_server.FakeSendbird.channel_url(0)
+    started = time.perf_counter()
+    count = rca.get_all_messages("bench", channel_url, 0, session, NullSink(), None, shards)
+    seconds = time.perf_counter() - started
+    assert count == args.messages, count
+    return _messages_result(count, -(-count // int(rca.MESSAGES_PARAMS["next_limit"])), seconds)
+
+
+def bench_messages_sharded(args):
+    return bench_messages(args, shards=4)
+
+
+def bench_messages_asyncio(args):
+    rca = archiver()
+    from reddit_chat_archiver import aio  # pylint: disable=import-outside-toplevel
+
+    if aio.aiohttp is None:
+        return None
+    channel_url = fake_server.FakeSendbird.channel_url(0)
+    started = time.perf_counter()
+    count = aio.run(aio.get_all_messages, "bench", channel_url, 0, sink=NullSink())
+    seconds = time.perf_counter() - started
+    assert count == args.messages, count
+    return _messages_result(count, -(-count // int(rca.MESSAGES_PARAMS["next_limit"])), seconds)
+
+
+def make_frames(count, channels):
+    frames = []
+    for i in range(count):
+        channel = i % channels
+        message = {
+            "message_id": 10**9 + i,
+            "channel_url": fake_server.FakeSendbird.channel_url(channel),
+            "created_at": 1600000000000 + i,
+            "message": "live message number %d, with a bit of text to make it realistic" % i,
+            "user": {"user_id": "t2_bench%d" % (i % 7), "nickname": "user%d" % (i % 7)},
+        }
+        frames.append(fake_server.message_frame(message))
+    return frames
+
+
+def bench_frames(args, archive=False):
+    rca = archiver()
+    channels = {fake_server.FakeSendbird.channel_url(i): {"type": "direct", "name": "chat %d" % i} for i in range(args.channels)}
+    frames = make_frames(args.frames, args.channels)
+    with open(os.devnull, "w", encoding="utf-8") as output, tempfile.TemporaryDirectory() as directory:
+        sink = rca.open_sink("jsonl", directory, True) if archive else None
+        pipeline = rca.StreamPipeline(channels, output, sink=sink)
+        chat = rca.Chat("ws://127.0.0.1:1/", channels, pipeline)
+        pipeline.start()
+        started = time.perf_counter()
+        for frame in frames:
+            chat.on_message(frame)
+        reader_seconds = time.perf_counter() - started
+        pipeline.stop()
+        seconds = time.perf_counter() - started
+        if sink is not None:
+            sink.close()
+    return {
+        "frames": len(frames),
+        "seconds": seconds,
+        "frames_per_s": len(frames) / seconds,
+        # What the websocket thread sees: the cost of handing a frame over, until the queue fills up
+        "reader_frames_per_s": len(frames) / reader_seconds,
+    }
+
+
+def bench_frames_archived(args):
+    return bench_frames(args, archive=True)
+
+
+def bench_json_decode(args):  # pylint: disable=unused-argument
+    page = bench_json.make_page(200)
+    result = bench_json.bench(jsonlib.BACKEND, page, 500)
+    return {"backend": result["backend"], "pages_per_s": 1e6 / result["us_per_page"], "mb_per_s": result["mb_per_s"]}
+
+
+def run_child(args):
+    endpoints.configure(args.server)
+    result = globals()["bench_" + args.child](args)
+    if result is not None:
+        result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    json.dump(result, sys.stdout)
+
+
+def run_benchmark(name, server, args):
+    command = [sys.executable, os.path.abspath(__file__), "--child", name, "--server", server]
+    command += ["--channels", str(args.channels), "--messages", str(args.messages), "--frames", str(args.frames)]
+    best = None
+    for _ in range(args.repeat):
+        result = json.loads(subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout)
+        if result is None:
+            return None
+        if best is None:
+            best = result
+        else:
+            for metric, value in result.items():
+                if metric.endswith("_per_s"):
+                    best[metric] = max(best[metric], value)
+                elif metric in ("seconds", "peak_rss_kb"):
+                    best[metric] = min(best[metric], value)
+    return best
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        for metric, value in result.items():
+            before = baseline.get(name, {}).get(metric)
+            if not isinstance(before, (int, float)) or not before:
+                continue
+            if metric.endswith("_per_s") and value < before * (1 - threshold):
+                regressions.append((name, metric, before, value))
+            elif metric == "peak_rss_kb" and value > before * (1 + threshold):
+                regressions.append((name, metric, before, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", help="Comma separated benchmarks to run (default: all of %s)" % ", ".join(BENCHMARKS))
+    parser.add_argument("--channels", type=int, default=2000, help="Chats on the fake server (default: %(default)s)")
+    parser.add_argument("--messages", type=int, default=20000, help="Messages per chat (default: %(default)s)")
+    parser.add_argument("--frames", type=int, default=100000, help="Frames fed through Chat (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark; the best is kept (default: %(default)s)")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--json", action="store_true", help="Print machine readable results")
+    parser.add_argument("--baseline", help="Results JSON file (from --output) to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Relative change from the baseline reported as a regression (default: %(default)s)",
+    )
+    parser.add_argument("--child", choices=BENCHMARKS, help=argparse.SUPPRESS)
+    parser.add_argument("--server", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    names = args.only.split(",") if args.only else BENCHMARKS
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s" % name)
+    results = {}
+    with fake_server.FakeSendbird(channels=args.channels, messages=args.messages) as server:
+        for name in names:
+            result = run_benchmark(name, server.url, args)
+            if result is None:
+                print("%s: skipped" % name, file=sys.stderr)
+                continue
+            results[name] = result
+            if not args.json:
+                metrics = ["%s=%.1f" % (metric, value) for metric, value in sorted(result.items()) if metric.endswith("_per_s")]
+                print("%-18s %s peak_rss_kb=%d" % (name, " ".join(metrics), result["peak_rss_kb"]))
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "json_backend": jsonlib.BACKEND,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "parameters": {"channels": args.channels, "messages": args.messages, "frames": args.frames, "repeat": args.repeat},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    if args.json:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print()
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("parameters") != report["parameters"]:
+            print("Warning: the baseline was run with %s" % baseline.get("parameters"), file=sys.stderr)
+        regressions = compare(results, baseline["results"], args.threshold)
+        for name, metric, before, after in regressions:
+            print("REGRESSION %s %s: %.1f -> %.1f (%+.1f%%)" % (name, metric, before, after, 100.0 * (after / before - 1)))
+        if regressions:
+            sys.exit(1)
+        print("No regression beyond %.0f%% of %s" % (100 * args.threshold, args.baseline), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Start-up time of the command line, for scripts that run it many times.
+#
+#   python benchmarks/startup.py [--runs 20] [--budget-ms 40] [--json]
+#
+# Times `reddit-chat-archiver -h` and `--version` (and, for reference, the interpreter alone), keeping the median of --runs.
+# The exit status is 1 when -h takes more than --budget-ms longer than the interpreter alone, or when it imports any of the
+# modules that only the commands themselves need.
+import argparse
+import json
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+DEFAULT_BUDGET_MS = 40
+HEAVY_MODULES = ["requests", "websocket", "colorama", "sqlite3", "aiohttp", "reddit_chat_archiver.reddit_chat_archiver"]
+
+
+def command():
+    # The installed console script if there is one, otherwise the same entry point from this checkout
+    script = shutil.which("reddit-chat-archiver")
+    if script:
+        return [script]
+    return [sys.executable, "-c", "from reddit_chat_archiver.cli import main; main()"]
+
+
+def median_ms(args, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def imported_modules(args):
+    # The modules still loaded when -h exits
+    code = "import atexit, sys; atexit.register(lambda: print(' '.join(sys.modules), file=sys.stderr)); "
+    code += "sys.argv = ['reddit-chat-archiver'] + %r; from reddit_chat_archiver.cli import main; main()" % args
+    result = subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    return set(result.stderr.decode().split())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20, help="Runs of each command; the median is kept (default: %(default)s)")
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=DEFAULT_BUDGET_MS,
+        help="Maximum time of -h on top of the interpreter's own start-up, in ms (default: %(default)s)",
+    )
+    parser.add_argument("--json", action="store_true", help="Print machine readable results")
+    args = parser.parse_args()
+
+    cli = command()
+    results = {
+        "python_ms": median_ms([sys.executable, "-c", "pass"], args.runs),
+        "help_ms": median_ms(cli + ["-h"], args.runs),
+        "version_ms": median_ms(cli + ["--version"], args.runs),
+    }
+    results["help_overhead_ms"] = results["help_ms"] - results["python_ms"]
+    heavy = sorted(set(HEAVY_MODULES) & imported_modules(["-h"]))
+
+    if args.json:
+        json.dump(dict(results, heavy_modules=heavy, budget_ms=args.budget_ms), sys.stdout, indent=1, sort_keys=True)
+        print()
+    else:
+        for name, value in results.items():
+            print("%-18s %7.1f" % (name, value))
+
+    failed = False
+    if results["help_overhead_ms"] > args.budget_ms:
+        print("OVER BUDGET: -h takes %.1fms more than python alone (budget %.0fms)" % (results["help_overhead_ms"], args.budget_ms))
+        failed = True
+    if heavy:
+        print("-h imports %s" % ", ".join(heavy))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
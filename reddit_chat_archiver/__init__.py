@@ -1,7 +1,15 @@
 # flake8: noqa
-import reddit_chat_archiver.reddit_chat_archiver
+import importlib
 
-from ._version import get_versions
 
-__version__ = get_versions()["version"]
-del get_versions
+def __getattr__(name):
+    # Resolved on first use, so that importing the package (and starting the command line) stays cheap: the archiver imports
+    # requests and websocket, and in a git checkout get_versions() runs git
+    if name == "__version__":
+        from ._version import get_versions
+
+        globals()["__version__"] = version = get_versions()["version"]
+        return version
+    if name == "reddit_chat_archiver":
+        return importlib.import_module(".reddit_chat_archiver", __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,360 @@
+import asyncio
+import logging
+import queue
+import time
+
+from .reddit_chat_archiver import (
+    DEFAULT_JOBS,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_SHARDS,
+    DEFAULT_TIMEOUT,
+    MESSAGES_PARAMS,
+    PageSpool,
+    REJECTED_STATUSES,
+    STATE_SAVE_INTERVAL,
+    ArchiverSession,
+    ChannelFilesSink,
+    StreamPipeline,
+    TextSink,
+    channel_details,
+    connect,
+    decode_json,
+    format_channel,
+    load_high_water_marks,
+    relogin,
+    resume_point,
+    save_high_water_marks,
+    shard_bounds,
+    shard_range,
+    update_high_water_mark,
+    websocket_url,
+)
+from . import endpoints
+from .metrics import METRICS, endpoint_of
+from .ratelimit import RATE_LIMITER, parse_retry_after
+from .retry import RETRY_POLICY
+from .tracing import TRACER
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+LOGGER = logging.getLogger(__name__)
+
+
+def make_session(key=None, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+    if aiohttp is None:
+        raise RuntimeError("The asyncio engine requires aiohttp (pip install aiohttp)")
+    connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+        headers={"Session-Key": key} if key else {},
+    )
+
+
+def run(func, *args, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, **kwargs):
+    async def _run():
+        async with make_session(args[0] if args else None, pool_size, timeout) as session:
+            return await func(*args, session=session, **kwargs)
+
+    return asyncio.run(_run())
+
+
+async def get_json(session, uri, params=None, rate_limiter=RATE_LIMITER, retry_policy=RETRY_POLICY):
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        retry_after = None
+        wait = rate_limiter.reserve()
+        if wait > 0:
+            METRICS.inc("rate_limit_wait_seconds_total", wait)
+            with TRACER.span("rate limiter", "http"):
+                await asyncio.sleep(wait)
+        sent = time.monotonic()
+        try:
+            with TRACER.span("GET %s" % endpoint_of(uri)[0], "http", url=uri, attempt=attempt) as span:
+                async with session.get(uri, params=params) as response:
+                    span["status"] = response.status
+                    body = await response.read()
+                    METRICS.request(uri, response.status, time.monotonic() - sent, len(body))
+                    if response.status == 429:
+                        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                        rate_limiter.throttled(retry_after)
+                    else:
+                        rate_limiter.succeeded()
+                    if not retry_policy.retryable("GET", response.status):
+                        response.raise_for_status()
+                        return decode_json(body)
+                    error = "HTTP %d" % response.status
+                    reason = response.status
+                    failure = aiohttp.ClientResponseError(
+                        response.request_info,
+                        response.history,
+                        status=response.status,
+                        message=response.reason,
+                        headers=response.headers,
+                    )
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+            METRICS.request(uri, type(e).__name__, time.monotonic() - sent)
+            error = failure = e
+            reason = type(e).__name__
+        delay = retry_policy.delay(attempt, retry_after)
+        if retry_policy.give_up(attempt, started, delay):
+            raise failure
+        METRICS.retry(uri, reason, delay)
+        LOGGER.warning("GET %s failed (%s); retrying in %.1fs (attempt %d)", uri, error, delay, attempt + 1)
+        await asyncio.sleep(delay)
+
+
+async def iter_group_channels(key, session):  # pylint: disable=unused-argument
+    params = {"limit": 100}
+    uri = f"{endpoints.API_URL}/v3/group_channels"
+    while True:
+        with TRACER.span("channels page", "page", token=params.get("token")) as span:
+            body = await get_json(session, uri, params)
+            span["channels"] = len(body["channels"])
+        for group_channel in body["channels"]:
+            yield group_channel
+        if not body.get("next"):
+            break
+        params["token"] = body["next"]
+
+
+async def iter_channels(key, session):
+    async for group_channel in iter_group_channels(key, session):
+        yield group_channel["channel_url"], channel_details(group_channel)
+
+
+async def get_all_channels(key, session):
+    return {url: details async for url, details in iter_channels(key, session)}
+
+
+async def list_channels(key, session):
+    async for url, details in iter_channels(key, session):
+        print(format_channel(url, details))
+
+
+async def iter_message_pages(key, channel_url, starting_timestamp=0, session=None):  # pylint: disable=unused-argument
+    params = dict(MESSAGES_PARAMS)
+    uri = f"{endpoints.API_URL}/v3/group_channels/{channel_url}/messages"
+
+    while True:
+        params["message_ts"] = str(starting_timestamp)
+        with TRACER.span("messages page", "page", channel=channel_url, message_ts=starting_timestamp) as span:
+            messages = (await get_json(session, uri, params))["messages"]
+            span["messages"] = len(messages)
+        METRICS.page(channel_url, len(messages))
+        if not messages:
+            break
+        yield messages
+        starting_timestamp = messages[-1]["created_at"]
+
+
+async def get_channel(key, channel_url, session):  # pylint: disable=unused-argument
+    return await get_json(session, f"{endpoints.API_URL}/v3/group_channels/{channel_url}")
+
+
+async def iter_shard_pages(key, channel_url, start, end, session):
+    async for messages in iter_message_pages(key, channel_url, start - 1, session):
+        in_range = shard_range(messages, start, end)
+        if in_range:
+            yield in_range
+        if end is not None and messages[-1]["created_at"] >= end:
+            return
+
+
+async def get_all_messages_sharded(
+    key, channel_url, starting_timestamp=0, session=None, sink=None, marks=None, shards=DEFAULT_SHARDS
+):
+    sink = sink or TextSink()
+    starting_timestamp, last_message_id = resume_point(marks, channel_url, starting_timestamp)
+    # Group channels' created_at is in seconds, messages' in milliseconds
+    created_at = (await get_channel(key, channel_url, session)).get("created_at", 0) * 1000
+    bounds = shard_bounds(max(starting_timestamp + 1, created_at), int(time.time() * 1000), shards)
+    spools = [PageSpool() for _ in bounds]
+    changed = [asyncio.Event() for _ in bounds]
+
+    async def fetch(shard, start, end):
+        try:
+            async for messages in iter_shard_pages(key, channel_url, start, end, session):
+                spools[shard].put(messages)
+                changed[shard].set()
+        finally:
+            spools[shard].finish()
+            changed[shard].set()
+
+    async def next_page(shard):
+        while not spools[shard].ready():
+            changed[shard].clear()
+            await changed[shard].wait()
+        return spools[shard].get()
+
+    count = 0
+    previous_ids = {last_message_id}
+    tasks = [asyncio.ensure_future(fetch(shard, start, end)) for shard, (start, end) in enumerate(bounds)]
+    try:
+        for shard, task in enumerate(tasks):
+            while True:
+                messages = await next_page(shard)
+                if messages is None:
+                    break
+                messages = [message for message in messages if message["message_id"] not in previous_ids]
+                if not messages:
+                    continue
+                previous_ids = {message["message_id"] for message in messages}
+                sink.write_page(channel_url, messages)
+                count += len(messages)
+                update_high_water_mark(marks, channel_url, messages)
+            await task
+    finally:
+        for task in tasks:
+            task.cancel()
+        for spool in spools:
+            spool.close()
+    return count
+
+
+async def get_all_messages(key, channel_url, starting_timestamp=0, session=None, sink=None, marks=None, shards=1):
+    if shards > 1:
+        return await get_all_messages_sharded(key, channel_url, starting_timestamp, session, sink, marks, shards)
+    sink = sink or TextSink()
+    count = 0
+    starting_timestamp, last_message_id = resume_point(marks, channel_url, starting_timestamp)
+    async for messages in iter_message_pages(key, channel_url, starting_timestamp, session):
+        if last_message_id is not None:
+            messages = [message for message in messages if message["message_id"] != last_message_id]
+        sink.write_page(channel_url, messages)
+        count += len(messages)
+        update_high_water_mark(marks, channel_url, messages)
+    return count
+
+
+async def archive_channel(key, channel_url, sink, session, marks=None, shards=1):
+    with TRACER.span("archive_channel", "channel", channel=channel_url) as span:
+        sink.start_channel(channel_url, append=bool(marks) and channel_url in marks)
+        try:
+            count = span["messages"] = await get_all_messages(key, channel_url, 0, session, sink, marks, shards)
+        finally:
+            sink.finish_channel(channel_url)
+    LOGGER.info("Archived %d messages from %s", count, channel_url)
+    return count
+
+
+async def archive_all(key, channels=None, sink=None, jobs=DEFAULT_JOBS, session=None, state=None, shards=1):
+    # Like reddit_chat_archiver.archive_all: jobs workers archive channels from a bounded queue, fed as they are listed
+    sink = sink or ChannelFilesSink(".")
+    marks = load_high_water_marks(state) if state else None
+    saved = time.monotonic()
+    failed = []
+    queue = asyncio.Queue(maxsize=jobs)
+
+    async def worker():
+        nonlocal saved
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            url, details = item
+            try:
+                await archive_channel(key, url, sink, session, marks, shards)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Failed to archive %s (%s)", details["name"], url)
+                failed.append(url)
+            if state and time.monotonic() - saved >= STATE_SAVE_INTERVAL:
+                save_high_water_marks(state, marks)
+                saved = time.monotonic()
+
+    async def produce():
+        if channels is None:
+            async for item in iter_channels(key, session):
+                yield item
+        else:
+            for item in channels.items():
+                yield item
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(jobs)]
+    try:
+        async for url, details in produce():
+            sink.write_channels({url: details})
+            await queue.put((url, details))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        if state:
+            save_high_water_marks(state, marks)
+    return failed
+
+
+async def stream_account(account, pipeline, session, channel_cache=None, credential_cache=None):
+    # One account's connection: a websocket on the shared event loop, feeding the shared pipeline, reconnected with backoff
+    username = account["username"]
+    rest_session = ArchiverSession(pool_size=2)
+    loop = asyncio.get_running_loop()
+
+    def login(rejected=False):
+        user_id, sb_access_token, key, all_channels = (relogin if rejected else connect)(
+            username, account["password"], account.get("twofa"), rest_session, channel_cache, credential_cache
+        )
+        pipeline.add_source(username, key, rest_session, all_channels)
+        return user_id, sb_access_token
+
+    try:
+        user_id, sb_access_token = await loop.run_in_executor(None, login)
+    except Exception:  # pylint: disable=broad-except
+        LOGGER.exception("Failed to log in as %s", username)
+        return
+    retry = 0
+    relogged = False
+    while True:
+        try:
+            async with session.ws_connect(websocket_url(user_id, sb_access_token), heartbeat=15) as ws:
+                retry = 0
+                relogged = False
+                LOGGER.info("Connected as %s!", username)
+                await loop.run_in_executor(None, pipeline.connected, username)
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        # Like Chat, only hands the frame over. Once the pipeline queue is full, this connection waits for room
+                        # on an executor thread, and stops reading meanwhile, without blocking the others.
+                        try:
+                            pipeline.feed(msg.data, username, block=False)
+                        except queue.Full:
+                            await loop.run_in_executor(None, pipeline.feed, msg.data, username)
+                    elif msg.type == aiohttp.WSMsgType.ERROR:
+                        LOGGER.error("Error received for %s! (%s)", username, ws.exception())
+                        break
+            LOGGER.error("Closed! (%s)", username)
+        except aiohttp.WSServerHandshakeError as e:
+            LOGGER.error("Error received for %s! (%s)", username, e)
+            if e.status in REJECTED_STATUSES:
+                if not credential_cache or relogged:
+                    return
+                relogged = True
+                try:
+                    user_id, sb_access_token = await loop.run_in_executor(None, login, True)
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception("Failed to log in as %s", username)
+                    return
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            LOGGER.error("Error received for %s! (%s)", username, e)
+        pipeline.disconnected(username)
+        retry += 1
+        LOGGER.warning("Sleeping (%s, try %s)", username, retry)
+        await asyncio.sleep(min(15, 2 ** (retry - 1)))
+
+
+async def stream_accounts(accounts, session=None, sink=None, state=None, channel_cache=None, credential_cache=None):
+    # Streams every account in one process: all the websockets share this event loop, and one StreamPipeline renders and
+    # archives their messages (a chat shared by several accounts is still written once)
+    pipeline = StreamPipeline({}, sink=sink, state=state)
+    pipeline.start()
+    try:
+        await asyncio.gather(*[stream_account(account, pipeline, session, channel_cache, credential_cache) for account in accounts])
+    finally:
+        pipeline.stop()
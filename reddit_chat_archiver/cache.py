@@ -0,0 +1,135 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from .reddit_chat_archiver import channel_details, iter_group_channels
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL_TTL = 3600  # seconds
+DEFAULT_CREDENTIAL_TTL = 6 * 24 * 3600  # Session keys are good for about a week
+
+# Serializes the read-modify-write of the cache files, which stream --accounts does from several threads
+WRITE_LOCK = threading.Lock()
+
+
+def default_cache_dir():
+    return os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "reddit-chat-archiver")
+
+
+def key_hash(key):
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def write_private_json(path, value):
+    # Written atomically, and readable only by the current user. The temporary file is unique (and created 0600 by mkstemp):
+    # WRITE_LOCK only serializes the threads of one process, and several processes may share the cache.
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_json(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+
+def channel_signature(group_channel):
+    # Everything channel_details() depends on, plus updated_at and the last message
+    last_message = group_channel.get("last_message") or {}
+    return [
+        group_channel.get("updated_at"),
+        last_message.get("message_id"),
+        group_channel.get("name"),
+        group_channel.get("custom_type"),
+        group_channel.get("data"),
+    ]
+
+
+class ChannelCache(object):
+    # The {channel_url: {type, name}} map of each account, cached on disk under its user_id (or, for a bare Session-Key, under
+    # the key's hash). Within ttl seconds of an account's last listing it is returned without any request; after that the
+    # channels are listed again, but only the ones whose signature changed are re-derived.
+    def __init__(self, path=None, ttl=DEFAULT_CHANNEL_TTL):
+        self.path = path or os.path.join(default_cache_dir(), "channels.json")
+        self.ttl = ttl
+
+    def _read(self):
+        # Skips anything that isn't an account's entry, like the single-account layout of older versions
+        accounts = read_json(self.path) or {}
+        return {name: entry for name, entry in accounts.items() if isinstance(entry, dict) and "fetched_at" in entry}
+
+    def get_all_channels(self, key, session=None, refresh=False, account=None):
+        account = account or key_hash(key)
+        accounts = self._read()
+        cached = accounts.get(account, {})
+        entries = cached.get("channels", {})
+        if not refresh and time.time() - cached.get("fetched_at", 0) < self.ttl:
+            LOGGER.info("Using %d cached channels of %s from %s", len(entries), account, self.path)
+            return {url: {"type": entry["type"], "name": entry["name"]} for url, entry in entries.items()}
+
+        fresh = {}
+        changed = 0
+        for group_channel in iter_group_channels(key, session):
+            url = group_channel["channel_url"]
+            signature = channel_signature(group_channel)
+            entry = entries.get(url)
+            if entry is None or entry["signature"] != signature:
+                entry = dict(channel_details(group_channel), signature=signature)
+                changed += 1
+            fresh[url] = entry
+        LOGGER.info("Refreshed %d channels of %s (%d changed) into %s", len(fresh), account, changed, self.path)
+        with WRITE_LOCK:
+            # Read again, so that accounts refreshed meanwhile are kept
+            accounts = self._read()
+            accounts[account] = {"fetched_at": time.time(), "channels": fresh}
+            write_private_json(self.path, accounts)
+        return {url: {"type": entry["type"], "name": entry["name"]} for url, entry in fresh.items()}
+
+
+class CredentialCache(object):
+    # The user_id, sb_access_token and Session-Key of each username, kept in a file readable only by the current user until
+    # they expire (after ttl seconds) or are invalidated because the server rejected them
+    def __init__(self, path=None, ttl=DEFAULT_CREDENTIAL_TTL):
+        self.path = path or os.path.join(default_cache_dir(), "credentials.json")
+        self.ttl = ttl
+
+    def get(self, username):
+        entry = (read_json(self.path) or {}).get(key_hash(username))
+        if entry is None or entry["expires_at"] <= time.time():
+            return None
+        LOGGER.info("Using cached credentials for %s (valid until %s)", username, time.ctime(entry["expires_at"]))
+        return entry["user_id"], entry["sb_access_token"], entry["key"]
+
+    def put(self, username, user_id, sb_access_token, key):
+        with WRITE_LOCK:
+            entries = read_json(self.path) or {}
+            now = time.time()
+            entries = {name: entry for name, entry in entries.items() if entry["expires_at"] > now}
+            entries[key_hash(username)] = {
+                "user_id": user_id,
+                "sb_access_token": sb_access_token,
+                "key": key,
+                "expires_at": now + self.ttl,
+            }
+            write_private_json(self.path, entries)
+
+    def invalidate(self, username):
+        with WRITE_LOCK:
+            entries = read_json(self.path) or {}
+            if entries.pop(key_hash(username), None) is not None:
+                write_private_json(self.path, entries)
@@ -0,0 +1,320 @@
+import argparse
+import datetime
+import logging
+import os
+
+from .defaults import DEFAULT_JOBS, DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT, ENGINES, FORMATS, SEARCH_ORDERS, WRITE_INTERVAL
+from .retry import DEFAULT_BACKOFF, DEFAULT_DEADLINE, DEFAULT_MAX_ATTEMPTS, DEFAULT_RETRY_STATUSES, parse_statuses
+
+# The command line. Building the parser only needs argparse and the light modules above; each command then imports what it
+# runs, so that -h, --version, usage errors, search and read-segments don't pay for importing requests, websocket and the
+# archiver.
+
+LOGGER = logging.getLogger(__name__)
+
+
+class VersionAction(argparse.Action):
+    # Like action="version", but the version is only looked up when asked for (in a git checkout, that runs git)
+    def __init__(self, option_strings, dest, **kwargs):
+        kwargs.setdefault("help", "show program's version number and exit")
+        super().__init__(option_strings, dest, default=argparse.SUPPRESS, nargs=0, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from . import __version__  # pylint: disable=import-outside-toplevel
+
+        print("%s %s" % (parser.prog, __version__))
+        parser.exit()
+
+
+def positive_float(value):
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError("must be positive: %s" % value)
+    return number
+
+
+def parse_time(value):
+    # Milliseconds since the epoch (like Sendbird's created_at), or an ISO 8601 date / date and time (UTC unless specified)
+    if value.isdigit():
+        return int(value)
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def format_search_result(result):
+    from .colors import Fore, Style  # pylint: disable=import-outside-toplevel
+
+    _, channel_url, channel_name, _, nickname, created_at, message = result
+    when = datetime.datetime.fromtimestamp(created_at / 1000, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    return (
+        Style.RESET_ALL
+        + when
+        + " "
+        + Fore.BLUE
+        + (channel_name or channel_url)
+        + " "
+        + Fore.RED
+        + (nickname or "")
+        + Fore.RESET
+        + ": "
+        + (message or "")
+    )
+
+
+def search(parser, args):
+    import sqlite3  # pylint: disable=import-outside-toplevel
+    from .store import SqliteStore  # pylint: disable=import-outside-toplevel
+
+    if not os.path.isfile(args.database):
+        parser.error("no such database: %s" % args.database)
+    try:
+        store = SqliteStore(args.database, readonly=True)
+        try:
+            results = store.search(args.query, args.channel, args.user, args.since, args.until, args.order, args.limit)
+        finally:
+            store.close()
+    except sqlite3.Error as e:
+        # Mostly FTS5 syntax errors in the query, e.g. an unquoted ' or -
+        parser.error("cannot search %s: %s" % (args.database, e))
+    for result in results:
+        print(format_search_result(result))
+
+
+def read_segments(parser, args):
+    from . import segments  # pylint: disable=import-outside-toplevel
+    from .sinks import JsonlSink, TextSink  # pylint: disable=import-outside-toplevel
+
+    if segments.load_index(args.directory, args.channel_url) is None:
+        parser.error("no segments for %s in %s" % (args.channel_url, args.directory))
+    sink = {"text": TextSink, "jsonl": JsonlSink}[args.format]()
+    page = []
+    for message in segments.read_range(args.directory, args.channel_url, args.since, args.until):
+        page.append(message)
+        if len(page) >= 1000:
+            sink.write_page(args.channel_url, page)
+            page = []
+    sink.write_page(args.channel_url, page)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-V", "--version", action=VersionAction)
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0, help="Print extra traces (INFO level). Use twice to print DEBUG prints"
+    )
+
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=DEFAULT_POOL_SIZE,
+        help="Maximum number of kept-alive HTTP connections (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=None, help="HTTP connect/read timeout in seconds (default: %s)" % (DEFAULT_TIMEOUT,)
+    )
+    parser.add_argument(
+        "--rate",
+        type=positive_float,
+        help="Maximum requests per second, shared by all workers; lowered automatically when throttled (default: no limit "
+        "until the server throttles a request, then half the rate that was throttled)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_MAX_ATTEMPTS - 1,
+        help="How many times a failed REST request is retried (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        type=float,
+        default=DEFAULT_BACKOFF,
+        help="Base of the jittered exponential backoff between retries, in seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--retry-deadline",
+        type=float,
+        default=DEFAULT_DEADLINE,
+        help="Give up on a REST request this many seconds after its first attempt (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--retry-statuses",
+        type=parse_statuses,
+        default=DEFAULT_RETRY_STATUSES,
+        help="Comma separated HTTP statuses to retry (default: %s)" % ",".join(str(status) for status in DEFAULT_RETRY_STATUSES),
+    )
+    parser.add_argument(
+        "--channel-cache", help="Cache file for the channel list (default: channels.json in $XDG_CACHE_HOME/reddit-chat-archiver)"
+    )
+    parser.add_argument(
+        "--channel-cache-ttl",
+        type=float,
+        default=0,
+        help="Reuse the cached channel list of stream and list-group-channels for this many seconds; 0 disables the cache "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default=ENGINES[0],
+        help="Fetch engine for list-group-channels, get-group-channel and archive-all (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--metrics", action="store_true", help="Record request, page and output metrics, and print a summary of them at exit"
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Write the metrics in the Prometheus text format to this file every %d seconds and at exit (implies --metrics)"
+        % WRITE_INTERVAL,
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="Serve the metrics in the Prometheus text format on this port (implies --metrics)"
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Write a timeline of the logins, requests, pages, JSON decoding and output writes to this file as they happen, in "
+        "the Chrome trace event format (open it in https://ui.perfetto.dev or chrome://tracing)",
+    )
+    parser.add_argument(
+        "--server",
+        help="Base URL of a Sendbird-compatible server (such as python -m reddit_chat_archiver.fake_server) to use for login, "
+        "REST and websocket requests instead of reddit's (default: $REDDIT_CHAT_ARCHIVER_SERVER)",
+    )
+
+    subparsers = parser.add_subparsers(title="Operation", help="Command to run", dest="action")
+    subparsers.required = True
+
+    login_parser = argparse.ArgumentParser(add_help=False)
+    login_parser.add_argument("-u", "--username", help="Reddit Username", default=os.getenv("REDDIT_USERNAME", None))
+    login_parser.add_argument("-p", "--password", help="Reddit Password", default=os.getenv("REDDIT_PASSWORD", None))
+    login_parser.add_argument("-2", "--2fa", dest="twofa", help="Reddit 2FA code", default=os.getenv("REDDIT_2FA", None))
+    login_parser.add_argument(
+        "--credential-cache",
+        help="Cache file for the login's user id, access token and Session-Key "
+        "(default: credentials.json in $XDG_CACHE_HOME/reddit-chat-archiver)",
+    )
+    login_parser.add_argument(
+        "--credential-cache-ttl",
+        type=float,
+        default=0,
+        help="Reuse cached credentials for this many seconds instead of logging in; 0 disables the cache (default: %(default)s)",
+    )
+    output_parser = argparse.ArgumentParser(add_help=False)
+    output_parser.add_argument("-f", "--format", choices=FORMATS, default=FORMATS[0], help="Output format (default: %(default)s)")
+    output_parser.add_argument(
+        "-s", "--state", help="JSON file of per-chat high-water marks; only messages newer than the stored mark are fetched"
+    )
+    output_parser.add_argument(
+        "--compression", choices=["gzip", "zstd"], default="gzip", help="Compression of the segments format (default: %(default)s)"
+    )
+    output_parser.add_argument("--segment-size", type=int, help="Messages per segment in the segments format")
+    parser_stream = subparsers.add_parser("stream", help="List all group channels and URLs", parents=[login_parser, output_parser])
+    parser_stream.add_argument(
+        "-o",
+        "--output",
+        help="Also archive live messages to this directory (text, jsonl: one file per chat; segments) or database (sqlite) "
+        "(default: only print them)",
+    )
+    parser_stream.add_argument(
+        "--accounts",
+        help='Stream every account in this JSON file (a list of {"username", "password", "twofa"} objects) in one process, '
+        "instead of the -u/-p/-2 account; requires aiohttp",
+    )
+    subparsers.add_parser("dump-session-key", help="List all group channels and URLs", parents=[login_parser])
+    parser_list_group_channels = subparsers.add_parser(
+        "list-group-channels", help="List all group channels and URLs"
+    )  # , parents=[common_parser])
+    parser_list_group_channels.add_argument(
+        "-k", "--key", help="Session-Key (get using Web Inspector from a browser)", default=os.getenv("REDDIT_SESSION_KEY", None)
+    )
+    archive_parser = argparse.ArgumentParser(add_help=False, parents=[output_parser])
+    archive_parser.add_argument(
+        "-k", "--key", help="Session-Key (get using Web Inspector from a browser)", default=os.getenv("REDDIT_SESSION_KEY", None)
+    )
+    archive_parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Split each chat's history into this many time ranges and fetch them concurrently (default: %(default)s)",
+    )
+    parser_get_group_channel = subparsers.add_parser(
+        "get-group-channel", help="Get all messages from the specified chat", parents=[archive_parser]
+    )
+    parser_get_group_channel.add_argument("channel_url", help="Channel URL")
+    parser_get_group_channel.add_argument(
+        "-o", "--output", help="File (text, jsonl), database (sqlite) or directory (segments) to write to (default: stdout)"
+    )
+    parser_archive_all = subparsers.add_parser(
+        "archive-all", help="Get all messages from every chat, one file per chat", parents=[archive_parser]
+    )
+    parser_archive_all.add_argument(
+        "-o",
+        "--output",
+        help="Directory (text, jsonl: one file per chat; segments) or database (sqlite) to write to (default: %(default)s)",
+        default=".",
+    )
+    parser_archive_all.add_argument(
+        "-j", "--jobs", type=int, default=DEFAULT_JOBS, help="Number of chats to archive concurrently (default: %(default)s)"
+    )
+
+    parser_read_segments = subparsers.add_parser(
+        "read-segments", help="Print the messages of a chat archived with --format segments"
+    )
+    parser_read_segments.set_defaults(parser=parser_read_segments)
+    parser_read_segments.add_argument("directory", help="Directory written with --format segments")
+    parser_read_segments.add_argument("channel_url", help="Channel URL")
+    parser_read_segments.add_argument("--since", type=parse_time, help="Only messages at or after this time (ISO 8601 or epoch ms)")
+    parser_read_segments.add_argument("--until", type=parse_time, help="Only messages before this time (ISO 8601 or epoch ms)")
+    parser_read_segments.add_argument(
+        "-f", "--format", choices=["text", "jsonl"], default="text", help="Output format (default: %(default)s)"
+    )
+
+    parser_search = subparsers.add_parser("search", help="Full-text search of a SQLite archive")
+    parser_search.set_defaults(parser=parser_search)  # to report bad queries with search's own usage
+    parser_search.add_argument("database", help="SQLite archive written with --format sqlite")
+    parser_search.add_argument(
+        "query", help='FTS5 query: words, "a phrase", prefix*, nickname: NAME, channel_name: NAME, AND/OR/NOT'
+    )
+    parser_search.add_argument("-c", "--channel", help="Only search this chat (URL or name)")
+    parser_search.add_argument("-u", "--user", help="Only search messages from this user (user id or nickname)")
+    parser_search.add_argument("--since", type=parse_time, help="Only messages at or after this time (ISO 8601 or epoch ms)")
+    parser_search.add_argument("--until", type=parse_time, help="Only messages before this time (ISO 8601 or epoch ms)")
+    parser_search.add_argument("--order", choices=SEARCH_ORDERS, default="newest", help="Result order (default: %(default)s)")
+    parser_search.add_argument("-n", "--limit", type=int, default=50, help="Maximum number of results (default: %(default)s)")
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    levels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    level = levels[min(len(levels) - 1, args.verbose)]
+    logging.basicConfig(
+        level=level,
+        format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    logging.getLogger("prawcore").setLevel(logging.ERROR)
+
+    from .colors import init  # pylint: disable=import-outside-toplevel
+
+    init()
+    if args.action == "search":
+        search(args.parser, args)
+    elif args.action == "read-segments":
+        read_segments(args.parser, args)
+    else:
+        from .reddit_chat_archiver import run_command  # pylint: disable=import-outside-toplevel
+
+        run_command(parser, args)
+    LOGGER.info("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+try:
+    from colorama import init, Fore, Style
+except ImportError:
+
+    def init():
+        pass
+
+    class Style(object):
+        pass
+
+    Style.RESET_ALL = ""
+
+    class Fore(object):
+        pass
+
+    Fore.RESET = Fore.RED = Fore.BLUE = Fore.GREEN = ""
+
+__all__ = ["init", "Fore", "Style"]
@@ -0,0 +1,30 @@
+import os
+import re
+import stat
+
+# Defaults shared by the archiver and the command line, which builds its parser without importing the archiver
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (10, 60)  # (connect, read) seconds
+DEFAULT_JOBS = 8
+DEFAULT_SHARDS = 4
+ENGINES = ["threads", "asyncio"]
+FORMATS = ["text", "jsonl", "sqlite", "segments"]
+WRITE_INTERVAL = 15  # seconds between two writes of --metrics-file
+# Read once, at import: os.umask can only be read by setting it, which would race with other threads creating files
+UMASK = os.umask(0)
+os.umask(UMASK)
+SEARCH_ORDERS = {"newest": "m.created_at DESC, m.message_id DESC", "oldest": "m.created_at, m.message_id", "rank": "f.rank"}
+
+
+def channel_filename(channel_url):
+    # The file (or segments directory) name of a chat
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", channel_url)
+
+
+def file_mode(path):
+    # The mode of the file a temporary file replaces, or that of a new file under the umask: mkstemp and NamedTemporaryFile
+    # create files readable only by the current user
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~UMASK
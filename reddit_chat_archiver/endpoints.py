@@ -0,0 +1,25 @@
+import os
+import urllib.parse
+
+HOST = "sendbirdproxyk8s.chat.redditmedia.com"
+
+# Read at call time (endpoints.API_URL, ...), so that configure() also redirects modules that were already imported
+API_URL = f"https://{HOST}"
+WS_URL = f"wss://{HOST}"
+REDDIT_URL = "https://www.reddit.com"
+REDDIT_API_URL = "https://s.reddit.com"
+
+
+def configure(server=None):
+    # Sends every request (login, REST and websocket) to one Sendbird-compatible server, such as fake_server
+    global API_URL, WS_URL, REDDIT_URL, REDDIT_API_URL  # pylint: disable=global-statement
+    if not server:
+        return
+    server = server.rstrip("/")
+    parsed = urllib.parse.urlsplit(server)
+    ws_scheme = "wss" if parsed.scheme == "https" else "ws"
+    API_URL = REDDIT_URL = REDDIT_API_URL = server
+    WS_URL = urllib.parse.urlunsplit((ws_scheme, parsed.netloc, parsed.path, "", ""))
+
+
+configure(os.getenv("REDDIT_CHAT_ARCHIVER_SERVER"))
@@ -0,0 +1,491 @@
+import argparse
+import base64
+import hashlib
+import http.server
+import json
+import logging
+import random
+import struct
+import threading
+import time
+import urllib.parse
+
+LOGGER = logging.getLogger(__name__)
+
+# A local stand-in for reddit's login pages and its Sendbird proxy (REST API and websocket), serving synthetic chats. Point
+# the archiver at it with --server (or $REDDIT_CHAT_ARCHIVER_SERVER):
+#
+#   python -m reddit_chat_archiver.fake_server --port 8080 --channels 20 --messages 5000 --live-rate 5
+#   reddit-chat-archiver --server http://127.0.0.1:8080 archive-all -k any -o /tmp/archive
+#
+# Only the fields and parameters the archiver relies on are implemented. Everything is stdlib, so it also runs where the
+# archiver's own dependencies are not installed.
+
+DEFAULT_CHANNELS = 10
+DEFAULT_MESSAGES = 1000
+DEFAULT_MESSAGE_SIZE = 40
+MESSAGE_STEP = 60 * 1000  # ms between two synthetic messages of a chat
+PAGE_LIMIT = 200  # largest next_limit / limit honored, like Sendbird's
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+REVOKED = "revoked"  # Session-Keys and access tokens containing it are rejected, to test expired credentials
+OP_TEXT, OP_CLOSE, OP_PING, OP_PONG = 0x1, 0x8, 0x9, 0xA
+
+
+def encode_frame(payload, opcode=OP_TEXT):
+    # Server to client frames are never masked
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def read_frame(rfile):
+    # Returns (opcode, payload), or (None, None) once the connection is closed. Fragmented messages are not supported; the
+    # archiver only sends pings and closes.
+    head = rfile.read(2)
+    if len(head) < 2:
+        return None, None
+    opcode = head[0] & 0x0F
+    length = head[1] & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", rfile.read(8))[0]
+    mask = rfile.read(4) if head[1] & 0x80 else None
+    payload = rfile.read(length)
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return opcode, payload
+
+
+def message_frame(message):
+    # The MESG frame the websocket sends for a (REST API shaped) message
+    frame = {
+        "msg_id": message["message_id"],
+        "channel_url": message["channel_url"],
+        "channel_type": "group",
+        "message": message["message"],
+        "data": message.get("data", ""),
+        "custom_type": message.get("custom_type", ""),
+        "ts": message["created_at"],
+        "updated_at": message.get("updated_at", 0),
+        "user": {"guest_id": message["user"]["user_id"], "name": message["user"]["nickname"], "image": ""},
+    }
+    return "MESG" + json.dumps(frame)
+
+
+class FakeSendbird(object):
+    # channels chats of messages synthetic messages each, one every MESSAGE_STEP ms up to the server's start. Messages sent
+    # live (live_rate per second, plus burst on each connection) are added to the history too, so backfills find them.
+    # Each REST request sleeps latency seconds, then fails with a 429 (throttle_rate) or a 5xx (error_rate) with the given
+    # probabilities. drop_after closes every websocket after that many frames, to exercise reconnects.
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        channels=DEFAULT_CHANNELS,
+        messages=DEFAULT_MESSAGES,
+        message_size=DEFAULT_MESSAGE_SIZE,
+        latency=0.0,
+        throttle_rate=0.0,
+        error_rate=0.0,
+        retry_after=1,
+        live_rate=0.0,
+        burst=0,
+        drop_after=0,
+        seed=0,
+    ):
+        self.channels = channels
+        self.messages = messages
+        self.message_size = message_size
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.live_rate = live_rate
+        self.burst = burst
+        self.drop_after = drop_after
+        self.started_at = int(time.time() * 1000)
+        self.first_created_at = self.started_at - messages * MESSAGE_STEP
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._live = [[] for _ in range(channels)]  # per chat, the messages sent live, oldest first
+        self._sockets = set()
+        self._stopped = threading.Event()
+        self._httpd = http.server.ThreadingHTTPServer((host, port), FakeSendbirdHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._threads = []
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._threads.append(threading.Thread(target=self._httpd.serve_forever, name="fake-sendbird", daemon=True))
+        if self.live_rate > 0:
+            self._threads.append(threading.Thread(target=self._send_live, name="fake-sendbird-live", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        LOGGER.info("Serving %d chats of %d messages on %s", self.channels, self.messages, self.url)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            sockets = list(self._sockets)
+        for socket in sockets:
+            socket.close()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def chance(self, probability):
+        with self._lock:
+            return probability > 0 and self._random.random() < probability
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    # Synthetic data
+
+    @staticmethod
+    def channel_url(index):
+        return "sendbird_group_channel_%d_%040x" % (index, index)
+
+    @staticmethod
+    def channel_index(channel_url):
+        try:
+            index = int(channel_url.split("_")[3])
+        except (IndexError, ValueError):
+            return None
+        return index
+
+    def _text(self, channel, i):
+        text = "message %d of chat %d " % (i, channel)
+        return (text * (self.message_size // len(text) + 1))[: self.message_size]
+
+    def _message(self, channel, i):
+        user = i % 3
+        return {
+            "type": "MESG",
+            "message_id": channel * 10**9 + i,
+            "channel_url": self.channel_url(channel),
+            "created_at": self.first_created_at + i * MESSAGE_STEP,
+            "updated_at": 0,
+            "message": self._text(channel, i),
+            "data": "",
+            "custom_type": "",
+            "user": {"user_id": "t2_fake%d" % user, "nickname": "user%d" % user, "profile_url": ""},
+        }
+
+    def history(self, channel, message_ts, include, limit):
+        # Up to limit messages created after message_ts (or at it, with include), oldest first
+        if include:
+            first = max(0, -(-(message_ts - self.first_created_at) // MESSAGE_STEP))
+        else:
+            first = max(0, (message_ts - self.first_created_at) // MESSAGE_STEP + 1)
+        page = [self._message(channel, i) for i in range(first, min(self.messages, first + limit))]
+        if len(page) < limit:
+            with self._lock:
+                live = list(self._live[channel])
+            page += [m for m in live if m["created_at"] > message_ts or (include and m["created_at"] == message_ts)]
+            page = page[:limit]
+        return page
+
+    def last_message(self, channel):
+        with self._lock:
+            if self._live[channel]:
+                return self._live[channel][-1]
+        return self._message(channel, self.messages - 1) if self.messages else None
+
+    def group_channel(self, index):
+        return {
+            "channel_url": self.channel_url(index),
+            "name": "Fake chat %d" % index,
+            "custom_type": "direct",
+            "data": "",
+            "created_at": self.first_created_at // 1000,
+            "member_count": 3,
+            "last_message": self.last_message(index),
+        }
+
+    # Live messages
+
+    def live_message(self, channel=None):
+        # Adds a message to the history of channel (a random one if None) and returns it as a MESG frame
+        with self._lock:
+            if channel is None:
+                channel = self._random.randrange(self.channels)
+            previous = self._live[channel][-1]["created_at"] if self._live[channel] else self.started_at
+            i = self.messages + len(self._live[channel])
+            message = self._message(channel, i)
+            message["created_at"] = max(int(time.time() * 1000), previous + 1)
+            self._live[channel].append(message)
+        return message_frame(message)
+
+    def _send_live(self):
+        while not self._stopped.wait(1.0 / self.live_rate):
+            if not self.channels:
+                continue
+            frame = self.live_message()
+            with self._lock:
+                sockets = list(self._sockets)
+            for socket in sockets:
+                socket.send(frame)
+
+    def register(self, socket):
+        with self._lock:
+            self._sockets.add(socket)
+
+    def unregister(self, socket):
+        with self._lock:
+            self._sockets.discard(socket)
+
+
+class FakeWebSocket(object):
+    # The server side of one websocket connection. Frames are sent from any thread; the reader answers pings and closes.
+    def __init__(self, handler, drop_after=0):
+        self._handler = handler
+        self._lock = threading.Lock()
+        self._drop_after = drop_after
+        self.sent = 0
+        self.closed = threading.Event()
+
+    def send(self, text, opcode=OP_TEXT):
+        with self._lock:
+            if self.closed.is_set():
+                return
+            try:
+                self._handler.wfile.write(encode_frame(text.encode() if isinstance(text, str) else text, opcode))
+                self._handler.wfile.flush()
+            except OSError:
+                self.closed.set()
+                return
+            if opcode == OP_TEXT:
+                self.sent += 1
+                if self._drop_after and self.sent >= self._drop_after:
+                    self._close()
+
+    def _close(self):
+        try:
+            self._handler.wfile.write(encode_frame(struct.pack("!H", 1001), OP_CLOSE))
+            self._handler.wfile.flush()
+        except OSError:
+            pass
+        self.closed.set()
+
+    def close(self):
+        with self._lock:
+            if not self.closed.is_set():
+                self._close()
+
+    def serve(self):
+        while not self.closed.is_set():
+            try:
+                opcode, payload = read_frame(self._handler.rfile)
+            except (OSError, struct.error):
+                opcode = None
+            if opcode is None or opcode == OP_CLOSE:
+                self.close()
+                return
+            if opcode == OP_PING:
+                self.send(payload, OP_PONG)
+
+
+class FakeSendbirdHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body are written separately; don't let each response wait for an ACK
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        LOGGER.debug("%s - " + format, self.address_string(), *args)
+
+    def _send_json(self, value, status=200, headers=None):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, header in (headers or {}).items():
+            self.send_header(name, header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, text, headers=None):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        for name, header in (headers or {}).items():
+            self.send_header(name, header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _fail(self, fake):
+        # Applies the configured latency and error profile; returns True if an error response was sent
+        fake.count_request()
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.chance(fake.throttle_rate):
+            self._send_json({"error": True, "message": "Too many requests"}, 429, {"Retry-After": str(fake.retry_after)})
+            return True
+        if fake.chance(fake.error_rate):
+            self._send_json({"error": True, "message": "Internal error"}, 500 if fake.chance(0.5) else 503)
+            return True
+        return False
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self._fail(self.server.fake):
+            return
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/post/login":
+            self._send_json({"json": {"errors": []}}, headers={"Set-Cookie": "reddit_session=fake-reddit-session; Path=/"})
+        else:
+            self._send_json({"error": True, "message": "Not found"}, 404)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        fake = self.server.fake
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        parts = [part for part in url.path.split("/") if part]
+
+        if self.headers.get("Upgrade", "").lower() == "websocket":
+            if REVOKED in query.get("access_token", ""):
+                self._send_json({"error": True, "message": "Invalid access token", "code": 400302}, 401)
+                return
+            self._websocket(fake, query)
+            return
+        if parts == ["chat"]:
+            # Just enough of the chat page for do_songbird_login's regular expressions
+            self._send_text('<script>{"accessToken":"fake-scoped-token","user":{"account":{"id":"t2_fakeuser"}}}</script>')
+            return
+        if parts == ["api", "v1", "sendbird", "me"]:
+            self._send_json({"sb_access_token": "fake-sb-access-token"})
+            return
+        if parts[:2] != ["v3", "group_channels"]:
+            self._send_json({"error": True, "message": "Not found"}, 404)
+            return
+        if not self.headers.get("Session-Key") or REVOKED in self.headers["Session-Key"]:
+            self._send_json({"error": True, "message": "Invalid session key", "code": 400302}, 401)
+            return
+        if self._fail(fake):
+            return
+
+        if len(parts) == 2:
+            limit = min(int(query.get("limit", 10)), PAGE_LIMIT)
+            start = int(query.get("token") or 0)
+            end = min(fake.channels, start + limit)
+            next_token = str(end) if end < fake.channels else ""
+            self._send_json({"channels": [fake.group_channel(i) for i in range(start, end)], "next": next_token})
+            return
+        index = fake.channel_index(parts[2])
+        if index is None or not 0 <= index < fake.channels:
+            self._send_json({"error": True, "message": "Channel not found", "code": 400201}, 400)
+        elif len(parts) == 3:
+            self._send_json(fake.group_channel(index))
+        elif parts[3:] == ["messages"]:
+            messages = fake.history(
+                index,
+                int(query.get("message_ts", 0)),
+                query.get("include", "true") == "true",
+                min(int(query.get("next_limit", 15)), PAGE_LIMIT),
+            )
+            self._send_json({"messages": messages})
+        else:
+            self._send_json({"error": True, "message": "Not found"}, 404)
+
+    def _websocket(self, fake, query):
+        accept = base64.b64encode(hashlib.sha1((self.headers["Sec-WebSocket-Key"] + WS_GUID).encode()).digest()).decode()
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        socket = FakeWebSocket(self, fake.drop_after)
+        user_id = query.get("user_id", "t2_fakeuser")
+        socket.send("LOGI" + json.dumps({"key": "fake-session-key-%s" % user_id, "user_id": user_id, "ping_interval": 15}))
+        fake.register(socket)
+        try:
+            for _ in range(fake.burst):
+                socket.send(fake.live_message())
+            socket.serve()
+        finally:
+            fake.unregister(socket)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for reddit's Sendbird chat servers")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on; 0 picks a free one (default: %(default)s)")
+    parser.add_argument("--channels", type=int, default=DEFAULT_CHANNELS, help="Number of chats (default: %(default)s)")
+    parser.add_argument("--messages", type=int, default=DEFAULT_MESSAGES, help="Messages per chat (default: %(default)s)")
+    parser.add_argument(
+        "--message-size", type=int, default=DEFAULT_MESSAGE_SIZE, help="Characters per message (default: %(default)s)"
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to each REST request (default: %(default)s)")
+    parser.add_argument(
+        "--throttle-rate", type=float, default=0.0, help="Fraction of REST requests answered with 429 (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Fraction of REST requests answered with 500/503 (default: %(default)s)"
+    )
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After of the 429s, in seconds (default: %(default)s)")
+    parser.add_argument(
+        "--live-rate", type=float, default=0.0, help="Live messages per second, to every websocket (default: %(default)s)"
+    )
+    parser.add_argument("--burst", type=int, default=0, help="Live messages sent to each new websocket (default: %(default)s)")
+    parser.add_argument(
+        "--drop-after", type=int, default=0, help="Close each websocket after this many messages; 0 never (default: %(default)s)"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the error profile and live messages (default: %(default)s)")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="Log requests (twice for every request)")
+    args = parser.parse_args()
+
+    levels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    logging.basicConfig(level=levels[min(len(levels) - 1, args.verbose)], format="%(asctime)s %(levelname)s %(message)s")
+    fake = FakeSendbird(
+        args.host,
+        args.port,
+        args.channels,
+        args.messages,
+        args.message_size,
+        args.latency,
+        args.throttle_rate,
+        args.error_rate,
+        args.retry_after,
+        args.live_rate,
+        args.burst,
+        args.drop_after,
+        args.seed,
+    )
+    fake.start()
+    print(f"Serving on {fake.url} (use --server {fake.url})", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
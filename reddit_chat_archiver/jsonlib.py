@@ -0,0 +1,43 @@
+import json
+import logging
+import os
+
+LOGGER = logging.getLogger(__name__)
+
+# Decoding pages and frames is the main CPU cost of an archive run, so use the fastest decoder installed. The backend can be
+# forced with $REDDIT_CHAT_ARCHIVER_JSON (orjson, simdjson or json).
+BACKENDS = ["orjson", "simdjson", "json"]
+
+
+def _stdlib_dumps(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
+def load_backend(name):
+    # Returns (loads, dumps) for the backend. loads accepts str or bytes, dumps returns str.
+    if name == "orjson":
+        import orjson  # pylint: disable=import-outside-toplevel
+
+        return orjson.loads, lambda value: orjson.dumps(value).decode()
+    if name == "simdjson":
+        import simdjson  # pylint: disable=import-outside-toplevel
+
+        # Only the decoder is faster; pysimdjson's dumps is the stdlib's
+        return simdjson.loads, _stdlib_dumps
+    if name == "json":
+        return json.loads, _stdlib_dumps
+    raise ValueError("Unknown JSON backend %s" % name)
+
+
+def select_backend(preferred=None):
+    for name in [preferred] if preferred else BACKENDS:
+        try:
+            return (name,) + load_backend(name)
+        except ImportError:
+            if preferred:
+                raise
+    raise AssertionError("The json backend is always available")
+
+
+BACKEND, loads, dumps = select_backend(os.getenv("REDDIT_CHAT_ARCHIVER_JSON"))
+LOGGER.debug("Using the %s JSON backend", BACKEND)
@@ -0,0 +1,319 @@
+import bisect
+import collections
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from .defaults import WRITE_INTERVAL, file_mode
+from .tracing import TRACER
+
+LOGGER = logging.getLogger(__name__)
+
+PREFIX = "reddit_chat_archiver_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # seconds
+PAGE_BUCKETS = (0, 1, 10, 50, 100, 150, 199, 200)  # messages
+QUANTILE_WINDOW = 60.0  # seconds of request latencies that request_seconds_recent's quantiles are computed over
+QUANTILES = (0.5, 0.95)
+
+# name -> (type, help, histogram buckets)
+METRICS_INFO = {
+    "requests_total": ("counter", "HTTP requests by endpoint, channel and status (or exception)", None),
+    "request_seconds": ("histogram", "HTTP request latency by endpoint, including reading the body", LATENCY_BUCKETS),
+    "request_seconds_recent": ("summary", "HTTP request latency by endpoint over the last %d seconds" % QUANTILE_WINDOW, None),
+    "response_bytes_total": ("counter", "HTTP response body bytes by endpoint and channel", None),
+    "retries_total": ("counter", "Retried HTTP requests by endpoint and reason", None),
+    "retry_sleep_seconds_total": ("counter", "Time spent sleeping before retries", None),
+    "rate_limit_wait_seconds_total": ("counter", "Time spent waiting for the rate limiter", None),
+    "pages_total": ("counter", "Message pages fetched by channel", None),
+    "messages_total": ("counter", "Messages fetched by channel", None),
+    "messages_per_page": ("histogram", "Messages per fetched page", PAGE_BUCKETS),
+    "sink_seconds": ("histogram", "Time spent writing output by sink operation", LATENCY_BUCKETS),
+}
+
+
+def endpoint_of(url):
+    # Returns (endpoint, channel_url) for a request URL, e.g. ("messages", "sendbird_group_channel_...")
+    path = [part for part in urllib.parse.urlsplit(url).path.split("/") if part]
+    if "group_channels" in path:
+        rest = path[path.index("group_channels") + 1 :]
+        if not rest:
+            return "group_channels", None
+        return ("messages" if rest[1:] == ["messages"] else "group_channel"), rest[0]
+    return (path[-1] if path else "/"), None
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, _escape(value)) for name, value in pairs) + "}"
+
+
+def _sample_quantile(values, q):
+    # The q-quantile of sorted values (nearest rank)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _quantile(buckets, counts, q):
+    # The upper bound of the bucket holding the q-quantile (None past the last bucket)
+    total = sum(counts)
+    if not total:
+        return None
+    seen = 0
+    for bound, count in zip(list(buckets) + [None], counts):
+        seen += count
+        if seen >= q * total:
+            return bound
+    return None
+
+
+class Metrics(object):
+    # Counters and histograms, keyed by name and labels, shared by every thread and the asyncio engine. Nothing is recorded
+    # until enable() is called, so the hooks cost a single attribute check otherwise.
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value, labels being a sorted tuple of (name, value) pairs
+        self._histograms = {}  # (name, labels) -> [count per bucket..., count past the last bucket, sum]
+        self._recent = {}  # endpoint -> deque of (time.monotonic(), latency) of the last QUANTILE_WINDOW seconds, oldest first
+        self._started = time.monotonic()
+
+    def enable(self):
+        self.enabled = True
+        self._started = time.monotonic()
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        buckets = METRICS_INFO[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    # Hooks
+
+    def request(self, url, status, seconds, size=0):
+        if not self.enabled:
+            return
+        endpoint, channel = endpoint_of(url)
+        self.inc("requests_total", endpoint=endpoint, channel=channel or "", status=status)
+        self.observe("request_seconds", seconds, endpoint=endpoint)
+        now = time.monotonic()
+        with self._lock:
+            samples = self._recent.setdefault(endpoint, collections.deque())
+            samples.append((now, seconds))
+            self._trim(samples, now)
+        if size:
+            self.inc("response_bytes_total", size, endpoint=endpoint, channel=channel or "")
+
+    def retry(self, url, reason, delay):
+        if not self.enabled:
+            return
+        self.inc("retries_total", endpoint=endpoint_of(url)[0], reason=reason)
+        self.inc("retry_sleep_seconds_total", delay)
+
+    def page(self, channel_url, count):
+        if not self.enabled:
+            return
+        self.inc("pages_total", channel=channel_url)
+        self.inc("messages_total", count, channel=channel_url)
+        self.observe("messages_per_page", count)
+
+    # Output
+
+    @staticmethod
+    def _trim(samples, now):
+        while samples and samples[0][0] < now - QUANTILE_WINDOW:
+            samples.popleft()
+
+    def recent_latencies(self):
+        # endpoint -> the sorted latencies of its requests of the last QUANTILE_WINDOW seconds
+        now = time.monotonic()
+        with self._lock:
+            for samples in self._recent.values():
+                self._trim(samples, now)
+            return {endpoint: sorted(seconds for _, seconds in samples) for endpoint, samples in self._recent.items() if samples}
+
+    def render(self):
+        # The Prometheus text exposition format
+        recent = self.recent_latencies()
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+        lines = []
+        for name, (kind, description, buckets) in METRICS_INFO.items():
+            full_name = PREFIX + name
+            lines.append("# HELP %s %s" % (full_name, description))
+            lines.append("# TYPE %s %s" % (full_name, kind))
+            if kind == "counter":
+                for (metric, labels), value in sorted(counters.items(), key=repr):
+                    if metric == name:
+                        lines.append("%s%s %s" % (full_name, _format_labels(labels), value))
+                continue
+            if kind == "summary":
+                for endpoint, values in sorted(recent.items()):
+                    labels = [("endpoint", endpoint)]
+                    for q in QUANTILES:
+                        lines.append(
+                            "%s%s %s" % (full_name, _format_labels(labels, [("quantile", q)]), _sample_quantile(values, q))
+                        )
+                    lines.append("%s_sum%s %s" % (full_name, _format_labels(labels), sum(values)))
+                    lines.append("%s_count%s %d" % (full_name, _format_labels(labels), len(values)))
+                continue
+            for (metric, labels), histogram in sorted(histograms.items(), key=repr):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ["+Inf"], histogram[:-1]):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (full_name, _format_labels(labels, [("le", bound)]), cumulative))
+                lines.append("%s_sum%s %s" % (full_name, _format_labels(labels), histogram[-1]))
+                lines.append("%s_count%s %d" % (full_name, _format_labels(labels), cumulative))
+        return "\n".join(lines) + "\n"
+
+    def _total(self, name, **match):
+        with self._lock:
+            items = list(self._counters.items())
+        return sum(value for (metric, labels), value in items if metric == name and match.items() <= dict(labels).items())
+
+    def summary(self):
+        with self._lock:
+            counters = list(self._counters.items())
+            latencies = {
+                dict(labels)["endpoint"]: list(h) for (name, labels), h in self._histograms.items() if name == "request_seconds"
+            }
+        lines = ["Finished in %.1fs" % (time.monotonic() - self._started)]
+        if latencies:
+            lines.append("%-16s %8s %8s %9s %9s %10s" % ("endpoint", "requests", "errors", "p50 (s)", "p95 (s)", "MB"))
+        for endpoint, histogram in sorted(latencies.items()):
+            requests = errors = size = 0
+            for (name, labels), value in counters:
+                labels = dict(labels)
+                if labels.get("endpoint") != endpoint:
+                    continue
+                if name == "requests_total":
+                    requests += value
+                    if not str(labels["status"]).startswith("2"):
+                        errors += value
+                elif name == "response_bytes_total":
+                    size += value
+            p50, p95 = (_quantile(LATENCY_BUCKETS, histogram[:-1], q) for q in (0.5, 0.95))
+            lines.append(
+                "%-16s %8d %8d %9s %9s %10.2f"
+                % (endpoint, requests, errors, "<=%g" % p50 if p50 else "-", "<=%g" % p95 if p95 else "-", size / 1e6)
+            )
+        pages = self._total("pages_total")
+        if pages:
+            messages = self._total("messages_total")
+            lines.append("%d messages in %d pages (%.1f per page)" % (messages, pages, messages / pages))
+        retries = self._total("retries_total")
+        lines.append(
+            "%d retries (%.1fs sleeping), %.1fs waiting for the rate limiter (summed over workers)"
+            % (retries, self._total("retry_sleep_seconds_total"), self._total("rate_limit_wait_seconds_total"))
+        )
+        with self._lock:
+            sink_seconds = sum(h[-1] for (name, _), h in self._histograms.items() if name == "sink_seconds")
+        lines.append("%.1fs writing output" % sink_seconds)
+        return "\n".join(lines)
+
+    def write(self, path):
+        # Through a temporary file of its own, so that runs writing the same path never replace each other's half-written file
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp", delete=False
+        ) as f:
+            f.write(self.render())
+            os.fchmod(f.fileno(), file_mode(path))
+        os.replace(f.name, path)
+
+    def write_periodically(self, path, interval=WRITE_INTERVAL):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write(path)
+                except OSError as e:
+                    LOGGER.warning("Could not write metrics to %s (%s)", path, e)
+
+        threading.Thread(target=run, name="metrics-writer", daemon=True).start()
+
+    def serve(self, port, host=""):
+        import http.server  # pylint: disable=import-outside-toplevel
+
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                body = metrics.render().encode()
+                self.send_response(200 if self.path in ("/", "/metrics") else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                LOGGER.debug("%s - " + format, self.address_string(), *args)
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        LOGGER.info("Serving metrics on http://%s:%d/metrics", host or "0.0.0.0", server.server_address[1])
+        return server
+
+    def finish(self, path=None):
+        # At exit: the last write of --metrics-file, and the summary on stderr
+        if path:
+            self.write(path)
+        print(self.summary(), file=sys.stderr)
+
+
+class MeteredSink(object):
+    # Wraps a Sink to time its writes, in the metrics and as trace spans
+    def __init__(self, sink, metrics, tracer=TRACER):
+        self._sink = sink
+        self._metrics = metrics
+        self._tracer = tracer
+
+    def _timed(self, operation, func, *args, channel=None):
+        started = time.monotonic()
+        try:
+            with self._tracer.span("sink " + operation, "output", channel=channel):
+                return func(*args)
+        finally:
+            self._metrics.observe("sink_seconds", time.monotonic() - started, operation=operation)
+
+    def write_channels(self, all_channels):
+        return self._timed("write_channels", self._sink.write_channels, all_channels)
+
+    def start_channel(self, channel_url, append=False):
+        return self._timed("start_channel", self._sink.start_channel, channel_url, append, channel=channel_url)
+
+    def write_page(self, channel_url, messages):
+        return self._timed("write_page", self._sink.write_page, channel_url, messages, channel=channel_url)
+
+    def finish_channel(self, channel_url):
+        return self._timed("finish_channel", self._sink.finish_channel, channel_url, channel=channel_url)
+
+    def close(self):
+        return self._timed("close", self._sink.close)
+
+
+METRICS = Metrics()
@@ -0,0 +1,112 @@
+import logging
+import math
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+MIN_RATE = 0.2  # requests per second
+INCREASE = 0.02  # fraction of the rate that was throttled regained after each successful request
+DECREASE_COOLDOWN = 1.0  # 429s for requests that were already in flight when the rate was lowered don't lower it again
+RATE_WINDOW = 1.0  # seconds over which the rate actually sent is measured
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils  # pylint: disable=import-outside-toplevel
+
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+    # Shared by every request of the process, from any thread or from the asyncio engine. Without max_rate, requests are not
+    # limited until the server throttles one: the rate is then set to half of what was being sent (and nothing is sent until
+    # the 429's Retry-After has passed), halved again on each 429, and grows back with every success. Once limited, requests
+    # go through a token bucket. max_rate (requests per second) caps the rate from the start; None, 0 or inf means no cap.
+    def __init__(self, max_rate=None):
+        self._lock = threading.Lock()
+        self.configure(max_rate)
+
+    def configure(self, max_rate=None):
+        with self._lock:
+            self.max_rate = max_rate if max_rate and not math.isinf(max_rate) else None
+            self.rate = self.max_rate  # None until throttled, when there is no cap
+            self._ceiling = self.max_rate
+            self._capacity = max(1.0, self.rate or 1.0)
+            self._tokens = self._capacity
+            self._updated = time.monotonic()
+            self._blocked_until = 0.0
+            self._decreased = 0.0
+            self._window_started = self._updated
+            self._window_count = 0
+            self._sent_rate = 0.0
+
+    def _count(self, now):
+        # Measures the rate actually sent, which the first 429 halves
+        elapsed = now - self._window_started
+        if elapsed >= RATE_WINDOW:
+            self._sent_rate = self._window_count / elapsed
+            self._window_started, self._window_count = now, 0
+        self._window_count += 1
+
+    def _set_rate(self, rate):
+        self.rate = rate
+        self._capacity = max(1.0, rate)
+        self._tokens = min(self._tokens, self._capacity)
+
+    def reserve(self):
+        # Takes a token, and returns how many seconds the caller has to wait before sending its request
+        with self._lock:
+            now = time.monotonic()
+            self._count(now)
+            if self.rate is None:
+                return max(0.0, self._blocked_until - now)
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._blocked_until - now)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._decreased >= DECREASE_COOLDOWN:
+                if self.rate is None:
+                    elapsed = now - self._window_started
+                    sent = max(self._sent_rate, self._window_count / elapsed if elapsed > 0 else 0.0)
+                    self._ceiling = max(MIN_RATE, sent)
+                    self._updated = now
+                    rate = self._ceiling / 2
+                else:
+                    rate = self.rate / 2
+                self._set_rate(max(MIN_RATE, rate))
+                self._decreased = now
+            self._tokens = min(self._tokens, 0.0)
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+            LOGGER.warning("Throttled by the server; slowing down to %.2f requests/s (retry after %ss)", self.rate, retry_after)
+
+    def succeeded(self):
+        # Grows back by steps of the rate that was throttled (or of max_rate); without a cap, it keeps growing past it, until the
+        # next 429
+        if self.rate is not None and (self.max_rate is None or self.rate < self.max_rate):
+            with self._lock:
+                rate = self.rate + self._ceiling * INCREASE
+                self._set_rate(min(self.max_rate, rate) if self.max_rate else rate)
+
+
+RATE_LIMITER = RateLimiter()
@@ -1,37 +1,106 @@
-import argparse
+import atexit
+import collections
+import concurrent.futures
+import contextlib
 import json
 import logging
 import os
+import queue
 import re
 import requests
+import sys
+import tempfile
+import threading
 import time
 import websocket
-from ._version import get_versions
 
 try:
-    from colorama import init, Fore, Style
-except ImportError:
+    import fcntl
+except ImportError:  # Windows: the state file is only locked between the threads of one process
+    fcntl = None
 
-    def init():
-        pass
+from . import cli, endpoints, jsonlib
+from .colors import Fore, Style
+from .defaults import DEFAULT_JOBS, DEFAULT_POOL_SIZE, DEFAULT_SHARDS, DEFAULT_TIMEOUT, file_mode
+from .metrics import METRICS, MeteredSink, endpoint_of
+from .ratelimit import RATE_LIMITER, parse_retry_after
+from .retry import RETRY_POLICY
+from .sinks import ChannelFilesSink, JsonlSink, TextSink, format_message, open_output
+from .store import SqliteStore
+from .tracing import TRACER
 
-    class Style(object):
-        pass
-
-    Style.RESET_ALL = ""
+AI = "2515BDA8-9D3A-47CF-9325-330BC37ADA13"  # This is reddit's chat AI.
+LOGGER = logging.getLogger(__name__)
 
-    class Fore(object):
-        pass
+STATE_SAVE_INTERVAL = 10  # seconds
+STATE_LOCK = threading.Lock()
+SHARD_MEMORY_PAGES = 16  # pages a shard keeps in memory while waiting for its turn to be written; the rest go to a temporary file
+REJECTED_STATUSES = (400, 401, 403)
+STREAM_QUEUE_SIZE = 10000  # frames buffered between the websocket reader and the render worker
+STREAM_BATCH_SIZE = 256
+STREAM_SEEN_SIZE = 100000  # message_ids remembered to skip live messages that were already archived
+STREAM_OPEN_CHANNELS = 32  # chats whose sink files stream keeps open; the least recently written one is closed past that
+STREAM_BACKFILL_MARGIN = 60 * 1000  # ms before a disconnect that backfills also cover, for chats without a cursor
 
-    Fore.RESET = Fore.RED = Fore.BLUE = Fore.GREEN = ""
 
+class ArchiverSession(requests.Session):
+    def __init__(
+        self, key=None, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, rate_limiter=RATE_LIMITER, retry_policy=RETRY_POLICY
+    ):
+        super().__init__()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        if key:
+            self.headers["Session-Key"] = key
 
-HOST = "sendbirdproxyk8s.chat.redditmedia.com"
-AI = "2515BDA8-9D3A-47CF-9325-330BC37ADA13"  # This is reddit's chat AI.
-LOGGER = logging.getLogger(__name__)
+    def request(self, method, url, **kwargs):  # pylint: disable=arguments-differ
+        kwargs.setdefault("timeout", self.timeout)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            retry_after = None
+            waited = time.monotonic()
+            with TRACER.span("rate limiter", "http"):
+                self.rate_limiter.acquire()
+            sent = time.monotonic()
+            METRICS.inc("rate_limit_wait_seconds_total", sent - waited)
+            try:
+                with TRACER.span("%s %s" % (method, endpoint_of(url)[0]), "http", url=url, attempt=attempt) as span:
+                    response = super().request(method, url, **kwargs)
+                    span["status"] = response.status_code
+            except (requests.ConnectionError, requests.Timeout) as e:
+                METRICS.request(url, type(e).__name__, time.monotonic() - sent)
+                if not self.retry_policy.retryable(method):
+                    raise
+                response, error, reason = None, e, type(e).__name__
+            else:
+                METRICS.request(url, response.status_code, time.monotonic() - sent, len(response.content))
+                if response.status_code == 429:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    self.rate_limiter.throttled(retry_after)
+                else:
+                    self.rate_limiter.succeeded()
+                if not self.retry_policy.retryable(method, response.status_code):
+                    return response
+                error = "HTTP %d" % response.status_code
+                reason = response.status_code
+            delay = self.retry_policy.delay(attempt, retry_after)
+            if self.retry_policy.give_up(attempt, started, delay):
+                if response is None:
+                    raise error
+                return response
+            METRICS.retry(url, reason, delay)
+            LOGGER.warning("%s %s failed (%s); retrying in %.1fs (attempt %d)", method, url, error, delay, attempt + 1)
+            time.sleep(delay)
 
 
-def do_songbird_login(username, password, twofa):
+def do_songbird_login(username, password, twofa, session=None):
+    session = session or ArchiverSession()
     headers = {
         "User-Agent": "Firefox",
         "Accept": "application/json, text/javascript, */*",
@@ -42,55 +111,344 @@ def do_songbird_login(username, password, twofa):
         "Sec-Fetch-Site": "same-origin",
     }
     data = {"op": "login", "user": username, "passwd": "%s%s" % (password, ":%s" % twofa if twofa else ""), "api_type": "json"}
-    response = requests.post("https://www.reddit.com/post/login", headers=headers, data=data, allow_redirects=False)
+    with TRACER.span("login reddit", "login"):
+        response = session.post(f"{endpoints.REDDIT_URL}/post/login", headers=headers, data=data, allow_redirects=False)
     reddit_session = response.cookies.get("reddit_session")
-    chat_r = requests.get("https://www.reddit.com/chat/", headers=headers, cookies={"reddit_session": reddit_session})
-    # This is ugly, but I don't feel like loading it into an XML parser just to find JS to find JSON
-    sendbird_scoped_token = re.search(b'"accessToken":"(.*?)"', chat_r.content).group(1).decode()
-    user_id = re.search(b'"user":{"account":{"id":"(.*?)"', chat_r.content).group(1).decode()
+    with TRACER.span("login chat page", "login"):
+        chat_r = session.get(f"{endpoints.REDDIT_URL}/chat/", headers=headers, cookies={"reddit_session": reddit_session})
+        # This is ugly, but I don't feel like loading it into an XML parser just to find JS to find JSON
+        sendbird_scoped_token = re.search(b'"accessToken":"(.*?)"', chat_r.content).group(1).decode()
+        user_id = re.search(b'"user":{"account":{"id":"(.*?)"', chat_r.content).group(1).decode()
     LOGGER.info("sendbird scoped token -> %s", sendbird_scoped_token)
     LOGGER.info("user id -> %s", user_id)
     headers = {"authorization": f"Bearer {sendbird_scoped_token}"}
-    response = requests.get("https://s.reddit.com/api/v1/sendbird/me", headers=headers)
-    sb_access_token = response.json()["sb_access_token"]
+    with TRACER.span("login sendbird token", "login"):
+        response = session.get(f"{endpoints.REDDIT_API_URL}/api/v1/sendbird/me", headers=headers)
+        sb_access_token = response.json()["sb_access_token"]
     LOGGER.info("sb_access_token -> %s", sb_access_token)
     return reddit_session, sendbird_scoped_token, user_id, sb_access_token
 
 
+def frame_to_message(frame):
+    # Live MESG frames carry the same message as the REST API, under different field names
+    user = frame.get("user") or {}
+    return {
+        "type": "MESG",
+        "message_id": frame["msg_id"],
+        "message": frame.get("message") or "",
+        "data": frame.get("data", ""),
+        "custom_type": frame.get("custom_type", ""),
+        "created_at": frame["ts"],
+        "updated_at": frame.get("updated_at", 0),
+        "channel_url": frame["channel_url"],
+        "channel_type": frame.get("channel_type", "group"),
+        "user": {"user_id": user.get("guest_id"), "nickname": user.get("name"), "profile_url": user.get("image", "")},
+    }
+
+
+def format_stream_message(message, channel_name):
+    return Style.RESET_ALL + Fore.BLUE + channel_name + " " + format_message(message)
+
+
+class StreamPipeline(object):
+    # Parses, renders and writes frames on its own thread, so that a slow terminal or pipe never stalls the websocket reader.
+    # With a sink, live messages are also archived (once each, by message_id), one page per chat and batch. Only the
+    # open_channels chats written most recently are kept started in the sink, and a page the sink fails to write is retried
+    # with the next batch.
+    # After a reconnect, whatever was sent while disconnected is fetched from the REST API; live messages are held back
+    # until that backfill is done, so each chat is still delivered in order. A source runs one backfill at a time: a gap found
+    # meanwhile is backfilled next, after the messages received before it.
+    # Several accounts (sources) can share one pipeline; the one given to the constructor is the None source.
+    def __init__(
+        self,
+        all_channels,
+        output=None,
+        key=None,
+        session=None,
+        sink=None,
+        state=None,
+        queue_size=STREAM_QUEUE_SIZE,
+        batch_size=STREAM_BATCH_SIZE,
+        open_channels=STREAM_OPEN_CHANNELS,
+    ):
+        self._all_channels = all_channels
+        self._output = output
+        self._sources = {None: (key, session)}
+        self._sink = sink
+        self._state = state
+        self._marks = load_high_water_marks(state) if state else None
+        self._saved = time.monotonic()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._batch_size = batch_size
+        self._pending = {}  # channel_url -> messages waiting for the channel's details
+        self._seen = collections.OrderedDict()  # The most recent message_ids, oldest first
+        # channel_url -> created_at of the last message delivered, where backfills start from
+        self._cursors = {url: mark["created_at"] for url, mark in (self._marks or {}).items()}
+        self._disconnected_at = {}
+        self._backfilling = set()
+        self._held = {}  # source -> live messages received while backfilling, and the cursors of the gaps found meanwhile
+        self._started = collections.OrderedDict()  # The chats started in the sink, least recently written first
+        self._open_channels = open_channels
+        self._lines = []
+        self._pages = {}
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            if self._sink is not None:
+                self._sink.write_channels(self._all_channels)
+            self._thread = threading.Thread(target=self._run, name="stream-pipeline", daemon=True)
+            self._thread.start()
+            if self._cursors and self._sources[None][0]:
+                # Catch up on what was sent since the archive was last updated
+                self._queue.put(("reconnected", None, None, int(time.time() * 1000)))
+
+    def add_source(self, source, key, session, all_channels):
+        self._sources[source] = (key, session)
+        self._queue.put(("channels", source, None, all_channels))
+        if self._cursors:
+            self._queue.put(("reconnected", source, None, int(time.time() * 1000)))
+
+    def feed(self, frame, source=None, block=True):
+        # Blocks once the queue is full, which pushes back on the reader instead of dropping frames; with block=False, raises
+        # queue.Full instead
+        self._queue.put(("frame", source, None, frame), block)
+
+    def disconnected(self, source=None):
+        self._disconnected_at.setdefault(source, int(time.time() * 1000))
+
+    def connected(self, source=None):
+        disconnected_at = self._disconnected_at.pop(source, None)
+        if disconnected_at is not None:
+            self._queue.put(("reconnected", source, None, disconnected_at - STREAM_BACKFILL_MARGIN))
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            if self._state:
+                save_high_water_marks(self._state, self._marks)
+
+    def _resolve(self, source, channel_url):
+        key, session = self._sources[source]
+        details = {"type": None, "name": channel_url}
+        try:
+            details = channel_details(get_channel(key, channel_url, session))
+        except (requests.RequestException, ValueError, KeyError) as e:
+            LOGGER.warning("Could not fetch details of new channel %s (%s)", channel_url, e)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception("Could not fetch details of new channel %s", channel_url)
+        finally:
+            # Always sent: the chat's messages wait for it, and nothing else looks the chat up again
+            self._queue.put(("channel", source, channel_url, details))
+
+    def _backfill(self, source, cursors, default):
+        # Only the chats whose last message is past their cursor are fetched
+        key, session = self._sources[source]
+        count = 0
+        try:
+            for group_channel in iter_group_channels(key, session):
+                channel_url = group_channel["channel_url"]
+                cursor = cursors.get(channel_url, default)
+                if (group_channel.get("last_message") or {}).get("created_at", 0) <= cursor:
+                    continue
+                try:
+                    for messages in iter_message_pages(key, channel_url, cursor, session):
+                        self._queue.put(("backfill", source, channel_url, messages))
+                        count += len(messages)
+                except (requests.RequestException, ValueError, KeyError) as e:
+                    LOGGER.warning("Backfill of %s failed; messages sent while disconnected may be missing (%s)", channel_url, e)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            LOGGER.warning("Backfill failed; messages sent while disconnected may be missing (%s)", e)
+        finally:
+            LOGGER.info("Backfilled %d messages", count)
+            self._queue.put(("backfilled", source, None, None))
+
+    def _is_new(self, message_id):
+        if message_id in self._seen:
+            self._seen.move_to_end(message_id)
+            return False
+        self._seen[message_id] = None
+        if len(self._seen) > STREAM_SEEN_SIZE:
+            self._seen.popitem(last=False)
+        return True
+
+    def _deliver(self, message, channel_name):
+        if not self._is_new(message["message_id"]):
+            return
+        channel_url = message["channel_url"]
+        self._cursors[channel_url] = max(self._cursors.get(channel_url, 0), message["created_at"])
+        self._lines.append(format_stream_message(message, channel_name))
+        if self._sink is not None:
+            self._pages.setdefault(channel_url, []).append(message)
+
+    def _on_message(self, source, message):
+        channel_url = message["channel_url"]
+        if channel_url in self._all_channels:
+            self._deliver(message, self._all_channels[channel_url]["name"])
+            return
+        if channel_url not in self._pending:
+            # Only the first message from an unknown channel starts a lookup; the rest wait for it
+            self._pending[channel_url] = []
+            threading.Thread(target=self._resolve, args=(source, channel_url), name="stream-resolve", daemon=True).start()
+        self._pending[channel_url].append(message)
+
+    def handle(self, event):
+        kind, source, channel_url, value = event
+        if kind == "frame":
+            msg_type = value[0:4]
+            if msg_type == "LOGI":
+                self._lines.append(Style.RESET_ALL + Fore.GREEN + "Logged in!" + Style.RESET_ALL)
+            if msg_type == "MESG":
+                message = frame_to_message(jsonlib.loads(value[4:]))
+                if source in self._backfilling:
+                    self._held.setdefault(source, []).append(message)
+                else:
+                    self._on_message(source, message)
+        elif kind == "channel":
+            self._all_channels[channel_url] = value
+            if self._sink is not None:
+                self._sink.write_channels({channel_url: value})
+            for message in self._pending.pop(channel_url, []):
+                self._deliver(message, value["name"])
+        elif kind == "channels":
+            self._all_channels.update(value)
+            if self._sink is not None:
+                self._sink.write_channels(value)
+        elif kind == "reconnected":
+            if source in self._backfilling:
+                self._held.setdefault(source, []).append(value)
+            else:
+                self._start_backfill(source, value)
+        elif kind == "backfill":
+            for message in value:
+                message.setdefault("channel_url", channel_url)
+                self._on_message(source, message)
+        elif kind == "backfilled":
+            self._backfilling.discard(source)
+            held = self._held.pop(source, [])
+            for i, item in enumerate(held):
+                if not isinstance(item, dict):
+                    self._start_backfill(source, item)
+                    if held[i + 1 :]:
+                        self._held[source] = held[i + 1 :]
+                    break
+                self._on_message(source, item)
+
+    def _start_backfill(self, source, default):
+        self._backfilling.add(source)
+        thread = threading.Thread(
+            target=self._backfill, args=(source, dict(self._cursors), default), name="stream-backfill", daemon=True
+        )
+        thread.start()
+
+    def _drain(self):
+        # Nothing more is coming: deliver what is still held back or waiting for its channel's details, rather than lose it
+        waiting = [item for held in self._held.values() for item in held if isinstance(item, dict)]
+        waiting += [message for pending in self._pending.values() for message in pending]
+        self._held, self._pending = {}, {}
+        for message in waiting:
+            self._deliver(message, self._all_channels.get(message["channel_url"], {}).get("name", message["channel_url"]))
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_page(self, channel_url, messages):
+        if channel_url in self._started:
+            self._started.move_to_end(channel_url)
+        else:
+            if len(self._started) >= self._open_channels:
+                # Every chat that ever gets a message would otherwise hold a file open until the process exits
+                self._sink.finish_channel(self._started.popitem(last=False)[0])
+            self._sink.start_channel(channel_url, append=True)
+            self._started[channel_url] = None
+        self._sink.write_page(channel_url, messages)
+
+    def _flush(self):
+        if self._lines:
+            output = self._output or sys.stdout
+            output.write("\n".join(self._lines) + "\n")
+            output.flush()
+            self._lines = []
+        failed = {}
+        for channel_url, messages in self._pages.items():
+            try:
+                self._write_page(channel_url, messages)
+            except Exception:  # pylint: disable=broad-except
+                # Kept for the next flush, and the chat's mark stays where it was, so that nothing is skipped
+                LOGGER.exception("Failed to write %d live messages of %s", len(messages), channel_url)
+                failed[channel_url] = messages
+                self._finish_channel(channel_url)
+                continue
+            # Only once the sink has the messages (see sinks.Sink), so that a restart never skips what was not written
+            update_high_water_mark(self._marks, channel_url, messages)
+        self._pages = failed
+        if self._state and time.monotonic() - self._saved >= STATE_SAVE_INTERVAL:
+            save_high_water_marks(self._state, self._marks)
+            self._saved = time.monotonic()
+
+    def _finish_channel(self, channel_url):
+        if channel_url in self._started:
+            del self._started[channel_url]
+            try:
+                self._sink.finish_channel(channel_url)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Failed to close %s", channel_url)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            with TRACER.span("stream batch", "stream", events=len(batch)):
+                for event in batch:
+                    if event is None:
+                        self._drain()
+                        break
+                    # One bad frame must not stop the pipeline: the websocket reader would block once the queue fills up
+                    try:
+                        self.handle(event)
+                    except (ValueError, KeyError) as e:
+                        LOGGER.warning("Could not handle %s event %r (%s)", event[0], str(event[3])[:80], e)
+                    except Exception:  # pylint: disable=broad-except
+                        LOGGER.exception("Could not handle %s event %r", event[0], str(event[3])[:80])
+                try:
+                    self._flush()
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception("Failed to write %d live messages", sum(len(page) for page in self._pages.values()))
+            if event is None:
+                for channel_url in list(self._started):
+                    self._finish_channel(channel_url)
+                return
+
+
 class Chat(object):
-    def __init__(self, url, all_channels):
+    def __init__(self, url, all_channels, pipeline=None):
         self.ws = websocket.WebSocketApp(
             url,
             on_open=lambda ws: self.on_open(),
             on_message=lambda ws, msg: self.on_message(msg),
             on_error=lambda ws, error: self.on_error(error),
-            on_close=lambda ws: self.on_close(),
+            on_close=lambda ws, *args: self.on_close(),  # websocket-client >= 0.58 also passes the close status and reason
         )
         self._all_channels = all_channels
+        self._pipeline = pipeline or StreamPipeline(all_channels)
         self._last_error = None
         self._retry = 0
+        self.rejected = False  # The handshake was refused, e.g. for an expired access token
 
     def on_open(self):
         self._retry = 0
         LOGGER.info("Connected!")
+        self._pipeline.connected()
 
     def on_message(self, msg):
-        msg_type = msg[0:4]
-        if msg_type == "LOGI":
-            print(Style.RESET_ALL + Fore.GREEN + "Logged in!" + Style.RESET_ALL)
-        if msg_type == "MESG":
-            j = json.loads(msg[4:])
-            print(
-                Style.RESET_ALL
-                + Fore.BLUE
-                + self._all_channels[j["channel_url"]]["name"]
-                + " "
-                + Fore.RED
-                + j["user"]["name"]
-                + Fore.RESET
-                + ": "
-                + j["message"]
-            )
+        self._pipeline.feed(msg)
 
     @staticmethod
     def on_close():
@@ -101,6 +459,13 @@ class Chat(object):
         LOGGER.error("Error received! (%s)", str(error))
 
     def start(self):
+        self._pipeline.start()
+        try:
+            self._run()
+        finally:
+            self._pipeline.stop()
+
+    def _run(self):
         while True:
             self.ws.run_forever(ping_interval=15, ping_timeout=5)
             if isinstance(
@@ -112,181 +477,599 @@ class Chat(object):
                     ConnectionError,
                 ),
             ):
+                self._pipeline.disconnected()
                 self._retry = self._retry + 1
                 LOGGER.warning("Sleeping (try %s)", self._retry)
                 time.sleep(min(15, 2 ** (self._retry - 1)))
                 LOGGER.warning("Reconnecting...")
                 continue
+            self.rejected = (
+                isinstance(self._last_error, websocket.WebSocketBadStatusException)
+                and self._last_error.status_code in REJECTED_STATUSES
+            )
             return
 
 
-def stream(username, password, twofa):
-    _, _, user_id, sb_access_token = do_songbird_login(username, password, twofa)
+def session_key_headers(key):
+    # The Session-Key goes with each Sendbird request rather than on the session, which also logs in to reddit
+    return {"Session-Key": key} if key else None
+
+
+def check_session_key(key, session=None):
+    # One small request, to find out whether the server still accepts a (cached) Session-Key
+    session = session or ArchiverSession()
+    response = session.get(f"{endpoints.API_URL}/v3/group_channels", params={"limit": 1}, headers=session_key_headers(key))
+    if response.status_code in REJECTED_STATUSES:
+        return False
+    response.raise_for_status()
+    return True
+
+
+def login(username, password, twofa, session=None, credential_cache=None):
+    cached = credential_cache.get(username) if credential_cache else None
+    if cached:
+        if check_session_key(cached[2], session):
+            return cached
+        LOGGER.warning("Cached credentials for %s were rejected; logging in again", username)
+        credential_cache.invalidate(username)
+    _, _, user_id, sb_access_token = do_songbird_login(username, password, twofa, session)
     key = get_session_key(user_id, sb_access_token)
-    all_channels = get_all_channels(key)
-    ws = Chat(
-        f"wss://sendbirdproxyk8s.chat.redditmedia.com/?p=_&pv=29&sv=3.0.82&ai={AI}&user_id={user_id}&access_token={sb_access_token}",
-        all_channels,
-    )
-    ws.start()
+    if credential_cache:
+        credential_cache.put(username, user_id, sb_access_token, key)
+    return user_id, sb_access_token, key
+
+
+def connect(username, password, twofa, session, channel_cache=None, credential_cache=None):
+    # Logs in (unless cached) and lists the account's channels; returns user_id, sb_access_token, key and the channels
+    user_id, sb_access_token, key = login(username, password, twofa, session, credential_cache)
+    if channel_cache:
+        all_channels = channel_cache.get_all_channels(key, session, account=user_id)
+    else:
+        all_channels = get_all_channels(key, session)
+    return user_id, sb_access_token, key, all_channels
 
 
-def dump_session_key(username, password, twofa):
-    _, _, user_id, sb_access_token = do_songbird_login(username, password, twofa)
-    return get_session_key(user_id, sb_access_token)
+def websocket_url(user_id, sb_access_token):
+    return f"{endpoints.WS_URL}/?p=_&pv=29&sv=3.0.82&ai={AI}&user_id={user_id}&access_token={sb_access_token}"
+
+
+def relogin(username, password, twofa, session, channel_cache=None, credential_cache=None):
+    # Like connect, once the websocket rejected the cached credentials: the Session-Key may still work while the cached access
+    # token no longer does, so login() would keep both
+    LOGGER.warning("The websocket rejected the cached credentials for %s; logging in again", username)
+    credential_cache.invalidate(username)
+    return connect(username, password, twofa, session, channel_cache, credential_cache)
+
+
+def stream(username, password, twofa, session=None, channel_cache=None, credential_cache=None, sink=None, state=None):
+    session = session or ArchiverSession()
+    credentials = connect(username, password, twofa, session, channel_cache, credential_cache)
+    for relogged in (False, True):
+        user_id, sb_access_token, key, all_channels = credentials
+        ws = Chat(
+            websocket_url(user_id, sb_access_token),
+            all_channels,
+            StreamPipeline(all_channels, key=key, session=session, sink=sink, state=state),
+        )
+        ws.start()
+        if relogged or not (ws.rejected and credential_cache):
+            return
+        credentials = relogin(username, password, twofa, session, channel_cache, credential_cache)
+
+
+def load_accounts(path):
+    # A JSON list of {"username": ..., "password": ..., "twofa": ...} objects; twofa is optional
+    with open(path, encoding="utf-8") as f:
+        accounts = json.load(f)
+    for account in accounts:
+        assert account.get("username") and account.get("password"), "Every account needs a username and a password"
+    return accounts
+
+
+def dump_session_key(username, password, twofa, session=None, credential_cache=None):
+    return login(username, password, twofa, session, credential_cache)[2]
 
 
 def get_session_key(user_id, sb_access_token):
-    ws = websocket.create_connection(
-        f"wss://sendbirdproxyk8s.chat.redditmedia.com/?p=_&pv=29&sv=3.0.82&ai={AI}&user_id={user_id}&access_token={sb_access_token}"
-    )
-    result = ws.recv()
-    ws.close()
-    key = json.loads(result[result.find("{") :])["key"]
+    with TRACER.span("get_session_key", "login"):
+        with TRACER.span("websocket connect", "login"):
+            ws = websocket.create_connection(websocket_url(user_id, sb_access_token))
+        with TRACER.span("websocket LOGI", "login"):
+            result = ws.recv()
+        ws.close()
+    key = jsonlib.loads(result[result.find("{") :])["key"]
     return key
 
 
-def get_all_channels(key):
+def channel_details(group_channel):
+    name = None
+    if not name:
+        name = group_channel["name"]
+    if not name:
+        participants = set()
+        try:
+            participants.add(group_channel.get("last_message", {}).get("user", {}).get("nickname", None))
+        except AttributeError:
+            pass
+        try:
+            participants.add(group_channel.get("created_by", {}).get("nickname", None))
+        except AttributeError:
+            pass
+        try:
+            participants.add(group_channel.get("inviter", {}).get("nickname", None))
+        except AttributeError:
+            pass
+        name = ", ".join(participants)
+    if not name:
+        name = "<unknown>"
+
+    try:
+        custom_type = "r/%s" % jsonlib.loads(group_channel["data"])["subreddit"]["name"]
+    except (ValueError, KeyError):
+        custom_type = group_channel["custom_type"]
+
+    return {"type": custom_type, "name": name}
+
+
+def decode_json(body):
+    with TRACER.span("json decode", "json", bytes=len(body)):
+        return jsonlib.loads(body)
+
+
+def iter_group_channels(key, session=None):
+    session = session or ArchiverSession(key)
     params = {"limit": 100}
-    uri = f"https://{HOST}/v3/group_channels"
-    headers = {"Session-Key": key}
-    response = requests.get(uri, headers=headers, params=params)
-    assert response.ok
-    group_channels = response.json()["channels"]
-    all_channels = {}
-    for group_channel in group_channels:
-        name = None
-        if not name:
-            name = group_channel["name"]
-        if not name:
-            participants = set()
-            try:
-                participants.add(group_channel.get("last_message", {}).get("user", {}).get("nickname", None))
-            except AttributeError:
-                pass
-            try:
-                participants.add(group_channel.get("created_by", {}).get("nickname", None))
-            except AttributeError:
-                pass
-            try:
-                participants.add(group_channel.get("inviter", {}).get("nickname", None))
-            except AttributeError:
-                pass
-            name = ", ".join(participants)
-        if not name:
-            name = "<unknown>"
+    uri = f"{endpoints.API_URL}/v3/group_channels"
+    while True:
+        with TRACER.span("channels page", "page", token=params.get("token")) as span:
+            response = session.get(uri, params=params, headers=session_key_headers(key))
+            response.raise_for_status()
+            body = decode_json(response.content)
+            span["channels"] = len(body["channels"])
+        yield from body["channels"]
+        if not body.get("next"):
+            break
+        params["token"] = body["next"]
+
+
+def iter_channels(key, session=None):
+    for group_channel in iter_group_channels(key, session):
+        yield group_channel["channel_url"], channel_details(group_channel)
 
-        try:
-            custom_type = "r/%s" % json.loads(group_channel["data"])["subreddit"]["name"]
-        except (json.decoder.JSONDecodeError, KeyError):
-            custom_type = group_channel["custom_type"]
-
-        all_channels[group_channel["channel_url"]] = {"type": custom_type, "name": name}
-    return all_channels
-
-
-def get_all_messages(key, channel_url, starting_timestamp=0):
-    params = {
-        "is_sdk": "true",
-        "prev_limit": "0",
-        "next_limit": "200",
-        "include": "false",
-        "reverse": "false",
-        "with_sorted_meta_array": "false",
-        "include_reactions": "false",
-        "message_ts": None,
-        "include_thread_info": "false",
-        "include_replies": "false",
-        "include_parent_message_text": "false",
-    }
 
-    uri = f"https://{HOST}/v3/group_channels/{channel_url}/messages"
+def get_all_channels(key, session=None):
+    return dict(iter_channels(key, session))
+
+
+def format_channel(url, details):
+    return "%-12s %-32s %s" % (details["type"], details["name"], url)
+
+
+MESSAGES_PARAMS = {
+    "is_sdk": "true",
+    "prev_limit": "0",
+    "next_limit": "200",
+    "include": "false",
+    "reverse": "false",
+    "with_sorted_meta_array": "false",
+    "include_reactions": "false",
+    "message_ts": None,
+    "include_thread_info": "false",
+    "include_replies": "false",
+    "include_parent_message_text": "false",
+}
+
+
+def iter_message_pages(key, channel_url, starting_timestamp=0, session=None):
+    session = session or ArchiverSession(key)
+    params = dict(MESSAGES_PARAMS)
+    uri = f"{endpoints.API_URL}/v3/group_channels/{channel_url}/messages"
 
     while True:
         params["message_ts"] = str(starting_timestamp)
-        headers = {"Session-Key": key}
-        response = requests.get(uri, headers=headers, params=params)
-        assert response.ok
-        messages = response.json()["messages"]
+        with TRACER.span("messages page", "page", channel=channel_url, message_ts=starting_timestamp) as span:
+            response = session.get(uri, params=params, headers=session_key_headers(key))
+            response.raise_for_status()
+            messages = decode_json(response.content)["messages"]
+            span["messages"] = len(messages)
+        METRICS.page(channel_url, len(messages))
         if not messages:
             break
-        for message in messages:
-            if message["type"] == "ADMM":
-                print("%s" % message["message"])
-            elif message["type"] == "MESG":
-                print(Style.RESET_ALL + Fore.RED + message["user"]["nickname"] + Fore.RESET + ": " + message["message"])
-            else:
-                print("UKNOWN MESSAGE: %s" % message)
+        yield messages
         starting_timestamp = messages[-1]["created_at"]
 
 
-def main():
-    init()
+def get_channel(key, channel_url, session=None):
+    session = session or ArchiverSession(key)
+    response = session.get(f"{endpoints.API_URL}/v3/group_channels/{channel_url}", headers=session_key_headers(key))
+    response.raise_for_status()
+    return decode_json(response.content)
 
-    parser = argparse.ArgumentParser()
 
-    parser.add_argument("-V", "--version", action="version", version="%(prog)s {version}".format(version=get_versions()["version"]))
-    parser.add_argument(
-        "-v", "--verbose", action="count", default=0, help="Print extra traces (INFO level). Use twice to print DEBUG prints"
-    )
+def shard_bounds(start, end, shards):
+    # Splits [start, end) into shards time ranges. The last one is left open, so it also picks up messages sent during the run
+    step = max(1, (end - start) // shards)
+    starts = [start + i * step for i in range(shards)]
+    return list(zip(starts, starts[1:] + [None]))
 
-    subparsers = parser.add_subparsers(title="Operation", help="Command to run", dest="action")
-    subparsers.required = True
-
-    parser_stream = subparsers.add_parser("stream", help="List all group channels and URLs")  # , parents=[common_parser])
-    parser_stream.add_argument("-u", "--username", help="Reddit Username", default=os.getenv("REDDIT_USERNAME", None))
-    parser_stream.add_argument("-p", "--password", help="Reddit Password", default=os.getenv("REDDIT_PASSWORD", None))
-    parser_stream.add_argument("-2", "--2fa", dest="twofa", help="Reddit 2FA code", default=os.getenv("REDDIT_2FA", None))
-    parser_dump_session_key = subparsers.add_parser(
-        "dump-session-key", help="List all group channels and URLs"
-    )  # , parents=[common_parser])
-    parser_dump_session_key.add_argument("-u", "--username", help="Reddit Username", default=os.getenv("REDDIT_USERNAME", None))
-    parser_dump_session_key.add_argument("-p", "--password", help="Reddit Password", default=os.getenv("REDDIT_PASSWORD", None))
-    parser_dump_session_key.add_argument("-2", "--2fa", dest="twofa", help="Reddit 2FA code", default=os.getenv("REDDIT_2FA", None))
-    parser_list_group_channels = subparsers.add_parser(
-        "list-group-channels", help="List all group channels and URLs"
-    )  # , parents=[common_parser])
-    parser_list_group_channels.add_argument(
-        "-k", "--key", help="Session-Key (get using Web Inspector from a browser)", default=os.getenv("REDDIT_SESSION_KEY", None)
-    )
-    parser_get_group_channel = subparsers.add_parser(
-        "get-group-channel", help="Get all messages from the specified chat"
-    )  # , parents=[common_parser])
-    parser_get_group_channel.add_argument("channel_url", help="Channel URL")
-    parser_get_group_channel.add_argument(
-        "-k", "--key", help="Session-Key (get using Web Inspector from a browser)", default=os.getenv("REDDIT_SESSION_KEY", None)
-    )
 
-    args = parser.parse_args()
+def shard_range(messages, start, end):
+    return [message for message in messages if start <= message["created_at"] and (end is None or message["created_at"] < end)]
+
+
+def iter_shard_pages(key, channel_url, start, end, session=None):
+    # message_ts is exclusive, so start a millisecond early to include messages sent exactly at start
+    for messages in iter_message_pages(key, channel_url, start - 1, session):
+        in_range = shard_range(messages, start, end)
+        if in_range:
+            yield in_range
+        if end is not None and messages[-1]["created_at"] >= end:
+            return
+
+
+class PageSpool(object):
+    # The pages of one shard, in order, from its fetcher to the writer. Up to memory_pages of them wait in memory, and the rest
+    # in a temporary file, so that the shards after the one being written don't hold most of a very large chat in memory.
+    # Not synchronized: callers wait for ready() and call put() and get() under their own lock.
+    def __init__(self, memory_pages=SHARD_MEMORY_PAGES):
+        self._memory = collections.deque()
+        self._memory_pages = memory_pages
+        self._file = None
+        self._spilled = 0  # pages in the file that were not read yet
+        self._offset = 0
+        self.done = False
+
+    def put(self, messages):
+        if not self._spilled and len(self._memory) < self._memory_pages:
+            self._memory.append(messages)
+            return
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()  # pylint: disable=consider-using-with
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(jsonlib.dumps(messages).encode() + b"\n")
+        self._spilled += 1
+
+    def finish(self):
+        self.done = True
+
+    def ready(self):
+        return bool(self._memory or self._spilled or self.done)
+
+    def get(self):
+        # The next page, or None once the fetcher is done and every page was read
+        if self._memory:
+            return self._memory.popleft()
+        if not self._spilled:
+            return None
+        self._file.seek(self._offset)
+        line = self._file.readline()
+        self._offset += len(line)
+        self._spilled -= 1
+        if not self._spilled:
+            self._file.seek(0)
+            self._file.truncate()
+            self._offset = 0
+        return jsonlib.loads(line)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def open_sink(fmt, output, per_channel=False, append=False, compression="gzip", segment_size=None):
+    sink = _open_sink(fmt, output, per_channel, append, compression, segment_size)
+    return MeteredSink(sink, METRICS) if METRICS.enabled or TRACER.enabled else sink
+
+
+def _open_sink(fmt, output, per_channel, append, compression, segment_size):
+    if fmt == "sqlite":
+        assert output, "--output is required for the sqlite format"
+        return SqliteStore(output)
+    if fmt == "segments":
+        from . import segments  # pylint: disable=import-outside-toplevel
+
+        assert output, "--output is required for the segments format"
+        return segments.SegmentSink(output, compression, segment_size or segments.DEFAULT_SEGMENT_SIZE)
+    sink_class, extension = {"text": (TextSink, ".txt"), "jsonl": (JsonlSink, ".jsonl")}[fmt]
+    if per_channel:
+        return ChannelFilesSink(output or ".", sink_class, extension)
+    if output:
+        return sink_class(open_output(output, append))
+    return sink_class()
+
+
+def load_high_water_marks(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
 
-    levels = [logging.WARNING, logging.INFO, logging.DEBUG]
-    level = levels[min(len(levels) - 1, args.verbose)]
-    logging.basicConfig(
-        level=level,
-        format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
+@contextlib.contextmanager
+def state_lock(path):
+    # Serializes the saves of a --state file, between the threads of this process and (where fcntl exists) other processes
+    with STATE_LOCK, open(path + ".lock", "a", encoding="utf-8") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def save_high_water_marks(path, marks):
+    # Merged into the marks saved meanwhile by other runs sharing the file, keeping the newest mark of each chat
+    with state_lock(path):
+        saved = load_high_water_marks(path)
+        for channel_url, mark in dict(marks).items():
+            if channel_url not in saved or saved[channel_url]["created_at"] <= mark["created_at"]:
+                saved[channel_url] = mark
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp", delete=False
+        ) as f:
+            json.dump(saved, f, indent=1, sort_keys=True)
+            os.fchmod(f.fileno(), file_mode(path))
+        os.replace(f.name, path)
+
+
+def resume_point(marks, channel_url, starting_timestamp=0):
+    # Returns the message_ts to start paging from, and the id of the last message already archived at that timestamp
+    mark = (marks or {}).get(channel_url)
+    if not mark or mark["created_at"] < starting_timestamp:
+        return starting_timestamp, None
+    return mark["created_at"], mark.get("message_id")
+
+
+def update_high_water_mark(marks, channel_url, messages):
+    if marks is not None and messages:
+        marks[channel_url] = {"created_at": messages[-1]["created_at"], "message_id": messages[-1]["message_id"]}
+
+
+def get_all_messages_sharded(key, channel_url, starting_timestamp=0, session=None, sink=None, marks=None, shards=DEFAULT_SHARDS):
+    # Fetches shards time ranges of the channel concurrently, and writes them in order: the earliest shard is written as it
+    # arrives, while later ones are spooled (see PageSpool) until all the shards before them are done
+    sink = sink or TextSink()
+    starting_timestamp, last_message_id = resume_point(marks, channel_url, starting_timestamp)
+    # Group channels' created_at is in seconds, messages' in milliseconds
+    created_at = get_channel(key, channel_url, session).get("created_at", 0) * 1000
+    bounds = shard_bounds(max(starting_timestamp + 1, created_at), int(time.time() * 1000), shards)
+    spools = [PageSpool() for _ in bounds]
+    changed = [threading.Condition() for _ in bounds]
+    stopped = threading.Event()
+
+    def fetch(shard, start, end):
+        try:
+            for messages in iter_shard_pages(key, channel_url, start, end, session):
+                if stopped.is_set():
+                    return
+                with changed[shard]:
+                    spools[shard].put(messages)
+                    changed[shard].notify()
+        finally:
+            with changed[shard]:
+                spools[shard].finish()
+                changed[shard].notify()
+
+    def next_page(shard):
+        with changed[shard]:
+            changed[shard].wait_for(spools[shard].ready)
+            return spools[shard].get()
+
+    count = 0
+    previous_ids = {last_message_id}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+            futures = [executor.submit(fetch, shard, start, end) for shard, (start, end) in enumerate(bounds)]
+            try:
+                for shard, future in enumerate(futures):
+                    for messages in iter(lambda: next_page(shard), None):  # pylint: disable=cell-var-from-loop
+                        # De-duplicate against the previous page, which may come from the shard before
+                        messages = [message for message in messages if message["message_id"] not in previous_ids]
+                        if not messages:
+                            continue
+                        previous_ids = {message["message_id"] for message in messages}
+                        sink.write_page(channel_url, messages)
+                        count += len(messages)
+                        update_high_water_mark(marks, channel_url, messages)
+                    future.result()
+            finally:
+                # On errors, the other fetchers stop at their next page rather than spool the rest of their range
+                stopped.set()
+    finally:
+        for spool in spools:
+            spool.close()
+    return count
+
+
+def get_all_messages(key, channel_url, starting_timestamp=0, session=None, sink=None, marks=None, shards=1):
+    if shards > 1:
+        return get_all_messages_sharded(key, channel_url, starting_timestamp, session, sink, marks, shards)
+    sink = sink or TextSink()
+    count = 0
+    starting_timestamp, last_message_id = resume_point(marks, channel_url, starting_timestamp)
+    for messages in iter_message_pages(key, channel_url, starting_timestamp, session):
+        if last_message_id is not None:
+            messages = [message for message in messages if message["message_id"] != last_message_id]
+        sink.write_page(channel_url, messages)
+        count += len(messages)
+        update_high_water_mark(marks, channel_url, messages)
+    return count
+
+
+def archive_channel(key, channel_url, sink, session=None, marks=None, shards=1):
+    # Incremental runs append to what the previous runs archived
+    with TRACER.span("archive_channel", "channel", channel=channel_url) as span:
+        sink.start_channel(channel_url, append=bool(marks) and channel_url in marks)
+        try:
+            count = span["messages"] = get_all_messages(key, channel_url, 0, session, sink, marks, shards)
+        finally:
+            sink.finish_channel(channel_url)
+    LOGGER.info("Archived %d messages from %s", count, channel_url)
+    return count
+
+
+def archive_all(key, channels=None, sink=None, jobs=DEFAULT_JOBS, session=None, state=None, shards=1):
+    # channels is a {url: details} map, or None to archive channels as they are listed. At most 2 * jobs channels are queued
+    # at a time, so accounts with thousands of channels are archived in bounded memory.
+    session = session or ArchiverSession(key, pool_size=jobs * shards)
+    channels = iter_channels(key, session) if channels is None else channels.items()
+    sink = sink or ChannelFilesSink(".")
+    marks = load_high_water_marks(state) if state else None
+    saved = time.monotonic()
+    failed = []
+    pending = {}
+
+    def collect(futures):
+        nonlocal saved
+        for future in futures:
+            url, details = pending.pop(future)
+            try:
+                future.result()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Failed to archive %s (%s)", details["name"], url)
+                failed.append(url)
+        if state and time.monotonic() - saved >= STATE_SAVE_INTERVAL:
+            save_high_water_marks(state, marks)
+            saved = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            for url, details in channels:
+                sink.write_channels({url: details})
+                pending[executor.submit(archive_channel, key, url, sink, session, marks, shards)] = (url, details)
+                if len(pending) >= 2 * jobs:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+            collect(concurrent.futures.as_completed(list(pending)))
+        finally:
+            if state:
+                save_high_water_marks(state, marks)
+    return failed
+
+
+def run_command(parser, args):
+    # Runs the parsed command line of every command but search and read-segments (see cli.main)
+    websocket.enableTrace(LOGGER.isEnabledFor(logging.DEBUG))
+
+    endpoints.configure(args.server)
+    if args.metrics or args.metrics_file or args.metrics_port:
+        METRICS.enable()
+        if args.metrics_port:
+            METRICS.serve(args.metrics_port)
+        if args.metrics_file:
+            METRICS.write_periodically(args.metrics_file)
+        atexit.register(METRICS.finish, args.metrics_file)
+    if args.trace:
+        TRACER.enable(args.trace)
+        atexit.register(TRACER.close)
+    RATE_LIMITER.configure(args.rate)
+    RETRY_POLICY.configure(
+        max_attempts=args.retries + 1, backoff=args.retry_backoff, deadline=args.retry_deadline, retry_statuses=args.retry_statuses
     )
+    pool_size = max(args.pool_size, getattr(args, "jobs", 1) * getattr(args, "shards", 1))
+    timeout = args.timeout or DEFAULT_TIMEOUT
+
+    session = ArchiverSession(getattr(args, "key", None), pool_size=pool_size, timeout=timeout)
+    if args.engine == "asyncio":
+        from . import aio  # pylint: disable=import-outside-toplevel
+    channel_cache = None
+    if args.channel_cache_ttl > 0:
+        from .cache import ChannelCache  # pylint: disable=import-outside-toplevel
 
-    websocket.enableTrace(level <= logging.DEBUG)
+        channel_cache = ChannelCache(args.channel_cache, args.channel_cache_ttl)
+    credential_cache = None
+    if getattr(args, "credential_cache_ttl", 0) > 0:
+        from .cache import CredentialCache  # pylint: disable=import-outside-toplevel
 
-    logging.getLogger("prawcore").setLevel(logging.ERROR)
+        credential_cache = CredentialCache(args.credential_cache, args.credential_cache_ttl)
 
     if args.action == "list-group-channels":
         assert args.key
-        all_channels = get_all_channels(args.key)
-        for url, details in all_channels.items():
-            print("%-12s %-32s %s" % (details["type"], details["name"], url))
+        if channel_cache:
+            for url, details in channel_cache.get_all_channels(args.key, session).items():
+                print(format_channel(url, details))
+        elif args.engine == "asyncio":
+            aio.run(aio.list_channels, args.key, pool_size=pool_size, timeout=timeout)
+        else:
+            for url, details in iter_channels(args.key, session):
+                print(format_channel(url, details))
 
     elif args.action == "get-group-channel":
         assert args.key
-        get_all_messages(args.key, args.channel_url, 0)
+        marks = load_high_water_marks(args.state) if args.state else None
+        # Like archive_channel: only a chat that was already archived is appended to
+        append = bool(marks) and args.channel_url in marks
+        sink = open_sink(args.format, args.output, False, append, args.compression, args.segment_size)
+        try:
+            sink.start_channel(args.channel_url, append)
+            if args.engine == "asyncio":
+                aio.run(
+                    aio.get_all_messages,
+                    args.key,
+                    args.channel_url,
+                    0,
+                    sink=sink,
+                    marks=marks,
+                    shards=args.shards,
+                    pool_size=pool_size,
+                    timeout=timeout,
+                )
+            else:
+                get_all_messages(args.key, args.channel_url, 0, session, sink, marks, args.shards)
+        finally:
+            sink.close()
+            if args.state:
+                save_high_water_marks(args.state, marks)
+    elif args.action == "archive-all":
+        assert args.key
+        sink = open_sink(args.format, args.output, True, False, args.compression, args.segment_size)
+        try:
+            if args.engine == "asyncio":
+                failed = aio.run(
+                    aio.archive_all,
+                    args.key,
+                    None,
+                    sink,
+                    args.jobs,
+                    state=args.state,
+                    shards=args.shards,
+                    pool_size=pool_size,
+                    timeout=timeout,
+                )
+            else:
+                failed = archive_all(args.key, None, sink, args.jobs, session, args.state, args.shards)
+        finally:
+            sink.close()
+        if failed:
+            parser.exit(1, "Failed to archive %d chats\n" % len(failed))
     elif args.action == "dump-session-key":
         assert args.username and args.password
-        key = dump_session_key(args.username, args.password, args.twofa)
+        key = dump_session_key(args.username, args.password, args.twofa, session, credential_cache)
         print(f"export REDDIT_SESSION_KEY={key}")
     elif args.action == "stream":
-        stream(args.username, args.password, args.twofa)
-    LOGGER.info("Done")
+        sink = open_sink(args.format, args.output, True, True, args.compression, args.segment_size) if args.output else None
+        try:
+            if args.accounts:
+                from . import aio  # pylint: disable=import-outside-toplevel
+
+                aio.run(
+                    aio.stream_accounts,
+                    accounts=load_accounts(args.accounts),
+                    sink=sink,
+                    state=args.state,
+                    channel_cache=channel_cache,
+                    credential_cache=credential_cache,
+                    pool_size=pool_size,
+                    timeout=timeout,
+                )
+            else:
+                stream(args.username, args.password, args.twofa, session, channel_cache, credential_cache, sink, args.state)
+        finally:
+            if sink:
+                sink.close()
+
+
+def main():
+    # The console script used to point here; the command line now lives in cli
+    cli.main()
 
 
 if __name__ == "__main__":
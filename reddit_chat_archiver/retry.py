@@ -0,0 +1,51 @@
+import random
+import time
+
+DEFAULT_MAX_ATTEMPTS = 6
+DEFAULT_BACKOFF = 0.5  # seconds, doubled on every attempt
+DEFAULT_MAX_BACKOFF = 30.0
+DEFAULT_DEADLINE = 300.0  # seconds, for all the attempts of one request
+DEFAULT_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RetryPolicy(object):
+    # How a failed request (a retryable status, a connection error or a timeout) is retried: up to max_attempts times, with
+    # "full jitter" exponential backoff, and never past deadline seconds after the first attempt. Paging requests are
+    # retried with the same parameters, so a retry resumes at the exact message_ts cursor that failed.
+    def __init__(self, **kwargs):
+        self.configure(**kwargs)
+
+    def configure(
+        self,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        backoff=DEFAULT_BACKOFF,
+        max_backoff=DEFAULT_MAX_BACKOFF,
+        deadline=DEFAULT_DEADLINE,
+        retry_statuses=DEFAULT_RETRY_STATUSES,
+        methods=("GET",),
+    ):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.retry_statuses = frozenset(retry_statuses)
+        self.methods = frozenset(methods)
+
+    def retryable(self, method, status=None):
+        return method.upper() in self.methods and (status is None or status in self.retry_statuses)
+
+    def delay(self, attempt, retry_after=None):
+        # The rate limiter already holds every request until Retry-After has passed
+        if retry_after is not None:
+            return 0.0
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def give_up(self, attempt, started, delay):
+        return attempt >= self.max_attempts or time.monotonic() + delay - started > self.deadline
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+def parse_statuses(value):
+    return tuple(int(status) for status in value.split(",") if status)
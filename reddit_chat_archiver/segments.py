@@ -0,0 +1,151 @@
+import gzip
+import json
+import logging
+import os
+import tempfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import jsonlib
+from .defaults import channel_filename, file_mode
+
+LOGGER = logging.getLogger(__name__)
+
+COMPRESSIONS = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+DEFAULT_SEGMENT_SIZE = 10000
+INDEX = "index.json"
+CHANNEL = "channel.json"
+
+
+def _open_segment(path, compression, mode):
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd segments require the zstandard package (pip install zstandard)")
+        return zstandard.open(path, mode + "t", encoding="utf-8")
+    return gzip.open(path, mode + "t", encoding="utf-8")
+
+
+def _write_json(path, value):
+    # Through a temporary file of its own: another run appending to the same chat never renames this one's half-written file
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+        json.dump(value, f, indent=1)
+        os.fchmod(f.fileno(), file_mode(path))
+    os.replace(f.name, path)
+
+
+def channel_dir(root, channel_url):
+    return os.path.join(root, channel_filename(channel_url))
+
+
+def load_index(root, channel_url):
+    try:
+        with open(os.path.join(channel_dir(root, channel_url), INDEX), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class SegmentSink(object):
+    # A Sink (see sinks.Sink) writing each channel as compressed JSONL segments of segment_size messages, in
+    # root/<channel>/. The channel's index.json lists each segment's file, created_at range, message count and the offset of its
+    # first message in the channel, so readers only decompress the segments that overlap the range they want. Each page is
+    # flushed and the index rewritten before write_page returns, so the --state marks never get ahead of what a reader (or a
+    # later run appending to the channel) can find, even if the process is killed with a segment still open.
+    def __init__(self, root, compression="gzip", segment_size=DEFAULT_SEGMENT_SIZE):
+        os.makedirs(root, exist_ok=True)
+        self._root = root
+        self._compression = compression
+        self._segment_size = segment_size
+        self._channels = {}
+
+    def write_channels(self, all_channels):
+        for channel_url, details in all_channels.items():
+            directory = channel_dir(self._root, channel_url)
+            os.makedirs(directory, exist_ok=True)
+            _write_json(os.path.join(directory, CHANNEL), dict(details, channel_url=channel_url))
+
+    def start_channel(self, channel_url, append=False):
+        directory = channel_dir(self._root, channel_url)
+        os.makedirs(directory, exist_ok=True)
+        # Appending keeps the compression the channel was first archived with
+        index = load_index(self._root, channel_url) if append else None
+        if index is None:
+            index = {"channel_url": channel_url, "compression": self._compression, "segments": []}
+        self._channels[channel_url] = {"index": index, "directory": directory, "file": None, "segment": None}
+
+    def _write_index(self, state):
+        _write_json(os.path.join(state["directory"], INDEX), state["index"])
+
+    def _close_segment(self, state):
+        if state["file"] is None:
+            return
+        state["file"].close()
+        state["file"] = None
+        self._write_index(state)
+
+    def _open_segment(self, state):
+        segments = state["index"]["segments"]
+        offset = segments[-1]["offset"] + segments[-1]["count"] if segments else 0
+        compression = state["index"]["compression"]
+        # A run that was killed may have left segments (or the start of one) that its index doesn't list: never overwrite them
+        number = len(segments)
+        while os.path.exists(os.path.join(state["directory"], "%08d%s" % (number, COMPRESSIONS[compression]))):
+            number += 1
+        name = "%08d%s" % (number, COMPRESSIONS[compression])
+        state["file"] = _open_segment(os.path.join(state["directory"], name), compression, "w")
+        # Listed in the index while still open: readers use its count, not the end of the file
+        state["segment"] = {"file": name, "first_created_at": None, "last_created_at": None, "count": 0, "offset": offset}
+        segments.append(state["segment"])
+
+    def write_page(self, channel_url, messages):
+        if channel_url not in self._channels:
+            self.start_channel(channel_url, append=True)
+        state = self._channels[channel_url]
+        for message in messages:
+            if state["file"] is None or state["segment"]["count"] >= self._segment_size:
+                self._close_segment(state)
+                self._open_segment(state)
+            segment = state["segment"]
+            state["file"].write(jsonlib.dumps(message) + "\n")
+            if segment["first_created_at"] is None:
+                segment["first_created_at"] = message["created_at"]
+            segment["last_created_at"] = message["created_at"]
+            segment["count"] += 1
+        if messages:
+            state["file"].flush()
+            self._write_index(state)
+
+    def finish_channel(self, channel_url):
+        self._close_segment(self._channels.pop(channel_url))
+
+    def close(self):
+        for channel_url in list(self._channels):
+            self.finish_channel(channel_url)
+
+
+def read_range(root, channel_url, since=None, until=None):
+    # Yields the archived messages of channel_url with since <= created_at < until, in order
+    index = load_index(root, channel_url)
+    if index is None:
+        raise FileNotFoundError("No segments for %s in %s" % (channel_url, root))
+    directory = channel_dir(root, channel_url)
+    for segment in index["segments"]:
+        if not segment["count"]:
+            continue
+        if since is not None and segment["last_created_at"] < since:
+            continue
+        if until is not None and segment["first_created_at"] >= until:
+            break
+        LOGGER.debug("Reading %s", segment["file"])
+        with _open_segment(os.path.join(directory, segment["file"]), index["compression"], "r") as f:
+            # Only the first count lines: a segment that is still open (or was never closed) ends without a trailer
+            for _, line in zip(range(segment["count"]), f):
+                message = jsonlib.loads(line)
+                if since is not None and message["created_at"] < since:
+                    continue
+                if until is not None and message["created_at"] >= until:
+                    return
+                yield message
@@ -0,0 +1,100 @@
+import os
+import sys
+
+from . import jsonlib
+from .colors import Fore, Style
+from .defaults import channel_filename
+
+# The text and JSONL outputs, which read-segments also uses without importing the archiver
+
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+
+class Sink(object):
+    # What write_page wrote must be readable (flushed, committed, indexed) when it returns: the high-water marks of --state
+    # are advanced right after it, and saved while archiving continues
+    def write_channels(self, all_channels):
+        pass
+
+    def start_channel(self, channel_url, append=False):
+        pass
+
+    def write_page(self, channel_url, messages):
+        raise NotImplementedError
+
+    def finish_channel(self, channel_url):
+        pass
+
+    def close(self):
+        pass
+
+
+def format_message(message, color=True):
+    if message["type"] == "ADMM":
+        return "%s" % message["message"]
+    if message["type"] == "MESG":
+        nickname = (message.get("user") or {}).get("nickname") or "<unknown>"
+        text = message.get("message") or ""
+        if not color:
+            return nickname + ": " + text
+        return Style.RESET_ALL + Fore.RED + nickname + Fore.RESET + ": " + text
+    return "UKNOWN MESSAGE: %s" % message
+
+
+def open_output(path, append=False):
+    return open(path, "a" if append else "w", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE)  # pylint: disable=consider-using-with
+
+
+class TextSink(Sink):
+    # Writes (and flushes) a whole page at a time; output=None means stdout, in color
+    def __init__(self, output=None, color=None):
+        self._output = output
+        self._color = output is None if color is None else color
+
+    def _write(self, text):
+        output = self._output or sys.stdout
+        output.write(text)
+        output.flush()
+
+    def write_page(self, channel_url, messages):
+        if messages:
+            self._write("".join([format_message(message, self._color) + "\n" for message in messages]))
+
+    def close(self):
+        if self._output is not None:
+            self._output.close()
+
+
+class JsonlSink(TextSink):
+    # The raw message objects, one per line
+    def write_page(self, channel_url, messages):
+        if messages:
+            self._write("".join([jsonlib.dumps(message) + "\n" for message in messages]))
+
+
+def channel_path(output_dir, channel_url, extension=".txt"):
+    return os.path.join(output_dir, channel_filename(channel_url) + extension)
+
+
+class ChannelFilesSink(Sink):
+    # One file per channel in output_dir, each written by its own sink_class instance
+    def __init__(self, output_dir, sink_class=TextSink, extension=".txt"):
+        os.makedirs(output_dir, exist_ok=True)
+        self._output_dir = output_dir
+        self._sink_class = sink_class
+        self._extension = extension
+        self._files = {}
+
+    def start_channel(self, channel_url, append=False):
+        path = channel_path(self._output_dir, channel_url, self._extension)
+        self._files[channel_url] = self._sink_class(open_output(path, append))
+
+    def write_page(self, channel_url, messages):
+        self._files[channel_url].write_page(channel_url, messages)
+
+    def finish_channel(self, channel_url):
+        self._files.pop(channel_url).close()
+
+    def close(self):
+        for channel_url in list(self._files):
+            self.finish_channel(channel_url)
@@ -0,0 +1,187 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import urllib.parse
+
+from . import jsonlib
+from .defaults import SEARCH_ORDERS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channels (
+    channel_url TEXT PRIMARY KEY,
+    type TEXT,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    message_id INTEGER PRIMARY KEY,
+    channel_url TEXT NOT NULL,
+    type TEXT,
+    user_id TEXT,
+    nickname TEXT,
+    message TEXT,
+    created_at INTEGER,
+    raw TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_channel_created_at ON messages (channel_url, created_at);
+CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at);
+"""
+
+# Full-text index over message text, nickname and channel name. Its rowid is the message_id, and triggers keep it in sync with
+# the messages and channels tables.
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE messages_fts USING fts5 (message, nickname, channel_name, tokenize = 'unicode61 remove_diacritics 2');
+CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, message, nickname, channel_name)
+    VALUES (new.message_id, new.message, new.nickname, (SELECT name FROM channels WHERE channel_url = new.channel_url));
+END;
+CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN
+    UPDATE messages_fts SET
+        message = new.message,
+        nickname = new.nickname,
+        channel_name = (SELECT name FROM channels WHERE channel_url = new.channel_url)
+    WHERE rowid = new.message_id;
+END;
+CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+    DELETE FROM messages_fts WHERE rowid = old.message_id;
+END;
+CREATE TRIGGER channels_fts_rename AFTER UPDATE OF name ON channels WHEN old.name IS NOT new.name BEGIN
+    UPDATE messages_fts SET channel_name = new.name
+    WHERE rowid IN (SELECT message_id FROM messages WHERE channel_url = new.channel_url);
+END;
+INSERT INTO messages_fts (rowid, message, nickname, channel_name)
+    SELECT m.message_id, m.message, m.nickname, c.name FROM messages m LEFT JOIN channels c USING (channel_url);
+"""
+
+UPSERT_CHANNEL = """
+INSERT INTO channels (channel_url, type, name) VALUES (?, ?, ?)
+ON CONFLICT (channel_url) DO UPDATE SET type = excluded.type, name = excluded.name
+WHERE channels.type IS NOT excluded.type OR channels.name IS NOT excluded.name
+"""
+
+UPSERT_MESSAGE = """
+INSERT INTO messages (message_id, channel_url, type, user_id, nickname, message, created_at, raw) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (message_id) DO UPDATE SET
+    channel_url = excluded.channel_url,
+    type = excluded.type,
+    user_id = excluded.user_id,
+    nickname = excluded.nickname,
+    message = excluded.message,
+    created_at = excluded.created_at,
+    raw = excluded.raw
+WHERE messages.raw IS NOT excluded.raw
+"""
+
+SEARCH = """
+SELECT m.message_id, m.channel_url, c.name, m.user_id, m.nickname, m.created_at, m.message
+FROM messages_fts f
+JOIN messages m ON m.message_id = f.rowid
+LEFT JOIN channels c ON c.channel_url = m.channel_url
+WHERE messages_fts MATCH ?
+"""
+
+# For queries with many matches, sorted by time: walks messages_created_at from the newest (or oldest) message, and stops at the
+# limit, instead of sorting every match. The + keeps SQLite from looking the matches up by message_id instead.
+SEARCH_BY_TIME = """
+SELECT m.message_id, m.channel_url, c.name, m.user_id, m.nickname, m.created_at, m.message
+FROM messages m
+LEFT JOIN channels c ON c.channel_url = m.channel_url
+WHERE +m.message_id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)
+"""
+
+COUNT_MATCHES = "SELECT count(*) FROM (SELECT 1 FROM messages_fts WHERE messages_fts MATCH ? LIMIT ?)"
+SCAN_MATCHES = 1000  # from this many matches on, newest and oldest use SEARCH_BY_TIME; fewer are simply sorted
+
+
+def message_row(channel_url, message):
+    user = message.get("user") or {}
+    return (
+        message["message_id"],
+        message.get("channel_url", channel_url),
+        message.get("type"),
+        user.get("user_id"),
+        user.get("nickname"),
+        message.get("message"),
+        message.get("created_at"),
+        jsonlib.dumps(message),
+    )
+
+
+def search_query(query, channel=None, user=None, since=None, until=None, order="newest", limit=50, by_time=False):
+    # query uses the FTS5 syntax, e.g. "exact phrase", prefix*, nickname: bob, channel_name: foo
+    sql = SEARCH_BY_TIME if by_time else SEARCH
+    params = [query]
+    if channel:
+        sql += " AND (m.channel_url = ? OR c.name = ?)"
+        params += [channel, channel]
+    if user:
+        sql += " AND (m.user_id = ? OR m.nickname = ?)"
+        params += [user, user]
+    if since is not None:
+        sql += " AND m.created_at >= ?"
+        params.append(since)
+    if until is not None:
+        sql += " AND m.created_at < ?"
+        params.append(until)
+    sql += " ORDER BY %s LIMIT ?" % SEARCH_ORDERS[order]
+    params.append(limit)
+    return sql, params
+
+
+class SqliteStore(object):
+    # A Sink (see sinks.Sink) that upserts channels and messages into a SQLite database.
+    # One connection is shared by all the archiving threads, so access is serialized by a lock.
+    # With readonly (for searching), the database must already exist, and is neither created nor migrated.
+    def __init__(self, path, readonly=False):
+        self._lock = threading.Lock()
+        if readonly:
+            uri = "file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(path))
+            self._db = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+            return
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.executescript(SCHEMA)
+        if not self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+            # New database, or one archived before the index existed: build it from what is already stored
+            self._db.executescript("BEGIN;" + FTS_SCHEMA + "COMMIT;")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def write_channels(self, all_channels):
+        rows = [(url, details["type"], details["name"]) for url, details in all_channels.items()]
+        with self._transaction() as db:
+            db.executemany(UPSERT_CHANNEL, rows)
+
+    def start_channel(self, channel_url, append=False):
+        pass
+
+    def write_page(self, channel_url, messages):
+        if not messages:
+            return
+        rows = [message_row(channel_url, message) for message in messages]
+        with self._transaction() as db:
+            db.execute("INSERT OR IGNORE INTO channels (channel_url) VALUES (?)", (channel_url,))
+            db.executemany(UPSERT_MESSAGE, rows)
+
+    def finish_channel(self, channel_url):
+        pass
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def search(self, query, channel=None, user=None, since=None, until=None, order="newest", limit=50):
+        with self._lock:
+            by_time = order != "rank" and self._db.execute(COUNT_MATCHES, (query, SCAN_MATCHES)).fetchone()[0] >= SCAN_MATCHES
+            sql, params = search_query(query, channel, user, since, until, order, limit, by_time)
+            return self._db.execute(sql, params).fetchall()
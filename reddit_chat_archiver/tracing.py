@@ -0,0 +1,100 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+# Spans in the Chrome trace event format (https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU),
+# which chrome://tracing, https://ui.perfetto.dev and speedscope open. Each thread, and each asyncio task, gets its own row.
+# Events are written to the file as they are recorded, in the format's JSON array form, so that a long stream --trace run
+# doesn't keep them in memory; the array is only closed at exit, which the viewers don't require.
+
+
+class Tracer(object):
+    # Nothing is recorded until enable() is called, so span() costs a single attribute check otherwise
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._file = None
+        self._lanes = {}  # thread or task -> tid
+        self._started = time.perf_counter()
+
+    def enable(self, path):
+        self._file = open(path, "w", encoding="utf-8")  # pylint: disable=consider-using-with
+        self._file.write("[\n")
+        self._started = time.perf_counter()
+        self.enabled = True
+
+    def _write(self, event):
+        self._file.write(json.dumps(event, separators=(",", ":")) + ",\n")
+
+    def _lane(self):
+        # Concurrent asyncio tasks share a thread, but their spans only nest within a task. asyncio is only looked up if some
+        # other module already imported it.
+        asyncio = sys.modules.get("asyncio")
+        task = None
+        if asyncio is not None:
+            try:
+                task = asyncio.current_task()
+            except RuntimeError:
+                pass
+        if task is not None:
+            key, name = id(task), "%s (%s)" % (task.get_name(), threading.current_thread().name)
+        else:
+            key, name = threading.get_ident(), threading.current_thread().name
+        tid = self._lanes.get(key)
+        if tid is None:
+            tid = self._lanes[key] = len(self._lanes) + 1
+            self._write({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}})
+        return tid
+
+    def complete(self, name, started, ended, category="archiver", **args):
+        # Records a span from two time.perf_counter() values
+        if not self.enabled:
+            return
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (started - self._started) * 1e6,
+            "dur": (ended - started) * 1e6,
+            "pid": os.getpid(),
+            "args": args,
+        }
+        with self._lock:
+            if self._file is None:
+                return
+            event["tid"] = self._lane()
+            self._write(event)
+
+    @contextlib.contextmanager
+    def _span(self, name, category, args):
+        started = time.perf_counter()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = type(e).__name__
+            raise
+        finally:
+            self.complete(name, started, time.perf_counter(), category, **args)
+
+    def span(self, name, category="archiver", **args):
+        # with TRACER.span("name", key=value) as args: ... args may be updated inside the block, e.g. with a result count
+        if not self.enabled:
+            return contextlib.nullcontext(args)
+        return self._span(name, category, args)
+
+    def close(self):
+        # At exit: the metadata event that ends the array (the viewers reject a trailing comma)
+        with self._lock:
+            if self._file is None:
+                return
+            self.enabled = False
+            self._file.write(json.dumps({"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": sys.argv[0]}}))
+            self._file.write("\n]\n")
+            self._file.close()
+            self._file = None
+
+
+TRACER = Tracer()
@@ -11,11 +11,12 @@ setup(
     author_email="github@mikeage.net",
     license="MIT",
     packages=["reddit_chat_archiver"],
-    entry_points={"console_scripts": ["reddit-chat-archiver=reddit_chat_archiver.reddit_chat_archiver:main"]},
+    entry_points={"console_scripts": ["reddit-chat-archiver=reddit_chat_archiver.cli:main"]},
     install_requires=[
         "colorama",
         "websocket-client @ git+ssh://git@github.com/mikeage/websocket-client@python39#egg=websocket-client",
         "requests",
     ],
+    extras_require={"asyncio": ["aiohttp"], "zstd": ["zstandard"], "fast-json": ["orjson"]},
     zip_safe=False,
 )
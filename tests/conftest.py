@@ -0,0 +1,48 @@
+import pytest
+
+from reddit_chat_archiver import endpoints
+from reddit_chat_archiver.fake_server import FakeSendbird
+from reddit_chat_archiver.reddit_chat_archiver import ArchiverSession
+from reddit_chat_archiver.sinks import Sink
+
+# Shared by the test modules: a fake server (the fake fixture) with CHANNELS chats of MESSAGES messages each
+KEY = "fake-session-key-t2_fakeuser"
+CHANNELS = 3
+MESSAGES = 450  # a few pages of 200
+
+
+class RecordingSink(Sink):
+    def __init__(self):
+        self.messages = {}
+
+    def write_page(self, channel_url, messages):
+        self.messages.setdefault(channel_url, []).extend(messages)
+
+
+def message_ids(messages):
+    return [message["message_id"] for message in messages]
+
+
+def expected_ids(fake, channel):
+    return [channel * 10**9 + i for i in range(fake.messages)]
+
+
+@pytest.fixture(autouse=True)
+def fixture_endpoints(monkeypatch):
+    # endpoints.configure() (from the fake fixture, or a command's --server) changes module globals: restore them after each test
+    for name in ["API_URL", "WS_URL", "REDDIT_URL", "REDDIT_API_URL"]:
+        monkeypatch.setattr(endpoints, name, getattr(endpoints, name))
+
+
+@pytest.fixture(name="fake")
+def fixture_fake():
+    with FakeSendbird(channels=CHANNELS, messages=MESSAGES) as fake:
+        endpoints.configure(fake.url)
+        yield fake
+
+
+@pytest.fixture(name="session")
+def fixture_session():
+    session = ArchiverSession(KEY)
+    yield session
+    session.close()
@@ -0,0 +1,118 @@
+import json
+import os
+
+import pytest
+
+from reddit_chat_archiver import defaults, endpoints, reddit_chat_archiver
+from reddit_chat_archiver.cli import main
+from reddit_chat_archiver.fake_server import FakeSendbird
+from reddit_chat_archiver.reddit_chat_archiver import iter_channels, load_high_water_marks, save_high_water_marks
+from reddit_chat_archiver.sinks import ChannelFilesSink, JsonlSink, channel_path
+
+from conftest import CHANNELS, KEY, MESSAGES, RecordingSink, expected_ids, message_ids
+
+
+@pytest.fixture(name="engine", params=["threads", "asyncio"])
+def fixture_engine(request, session):
+    # Calls a function of the threaded engine, or its counterpart in aio (in an event loop and aiohttp session of its own)
+    if request.param == "threads":
+        return lambda name, *args, **kwargs: getattr(reddit_chat_archiver, name)(*args, session=session, **kwargs)
+    pytest.importorskip("aiohttp")
+    from reddit_chat_archiver import aio  # pylint: disable=import-outside-toplevel
+
+    return lambda name, *args, **kwargs: aio.run(getattr(aio, name), *args, **kwargs)
+
+
+@pytest.mark.parametrize("shards", [1, 4])
+def test_get_all_messages(fake, engine, shards):
+    sink = RecordingSink()
+    url = fake.channel_url(1)
+    assert engine("get_all_messages", KEY, url, sink=sink, shards=shards) == MESSAGES
+    assert message_ids(sink.messages[url]) == expected_ids(fake, 1)
+
+
+@pytest.mark.parametrize("shards", [1, 4])
+def test_get_all_messages_resumes_from_marks(fake, engine, shards):
+    sink = RecordingSink()
+    url = fake.channel_url(0)
+    marks = {}
+    engine("get_all_messages", KEY, url, sink=sink, marks=marks, shards=shards)
+    assert marks[url]["message_id"] == expected_ids(fake, 0)[-1]
+    fake.live_message(0)
+    assert engine("get_all_messages", KEY, url, sink=sink, marks=marks, shards=shards) == 1
+    assert message_ids(sink.messages[url]) == expected_ids(fake, 0) + [MESSAGES]
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_archive_all_state_reruns(fake, engine, tmp_path):
+    state = str(tmp_path / "state.json")
+    output = str(tmp_path / "out")
+
+    def run():
+        sink = ChannelFilesSink(output, JsonlSink, ".jsonl")
+        try:
+            assert engine("archive_all", KEY, sink=sink, jobs=2, state=state, shards=2) == []
+        finally:
+            sink.close()
+        return {i: message_ids(read_jsonl(channel_path(output, fake.channel_url(i), ".jsonl"))) for i in range(CHANNELS)}
+
+    assert run() == {i: expected_ids(fake, i) for i in range(CHANNELS)}
+    # Nothing new: nothing is written twice
+    assert run() == {i: expected_ids(fake, i) for i in range(CHANNELS)}
+    # Only the new message is appended
+    fake.live_message(2)
+    archived = run()
+    assert archived[2] == expected_ids(fake, 2) + [2 * 10**9 + MESSAGES]
+    assert archived[0] == expected_ids(fake, 0)
+
+
+def test_get_group_channel_state(fake, tmp_path):
+    # A state file with marks of other chats only: the chat's first fetch starts a fresh file, and the next one appends to it
+    state = str(tmp_path / "state.json")
+    output = str(tmp_path / "chat.jsonl")
+    with open(state, "w", encoding="utf-8") as f:
+        json.dump({fake.channel_url(0): {"created_at": 1, "message_id": 1}}, f)
+    with open(output, "w", encoding="utf-8") as f:
+        f.write("an older export\n")
+    url = fake.channel_url(1)
+    command = ["--server", fake.url, "get-group-channel", url, "-k", KEY, "-f", "jsonl", "-o", output, "-s", state]
+    main(command)
+    assert message_ids(read_jsonl(output)) == expected_ids(fake, 1)
+    fake.live_message(1)
+    main(command)
+    assert message_ids(read_jsonl(output)) == expected_ids(fake, 1) + [10**9 + MESSAGES]
+
+
+def test_save_high_water_marks_merges(tmp_path):
+    # Like two runs sharing a state file: neither loses the other's marks, nor moves one back
+    state = str(tmp_path / "state.json")
+    save_high_water_marks(state, {"a": {"created_at": 5, "message_id": 5}, "b": {"created_at": 1, "message_id": 1}})
+    save_high_water_marks(state, {"a": {"created_at": 2, "message_id": 2}, "c": {"created_at": 3, "message_id": 3}})
+    assert {url: mark["created_at"] for url, mark in load_high_water_marks(state).items()} == {"a": 5, "b": 1, "c": 3}
+    # The file keeps its mode through the temporary file that replaces it
+    assert os.stat(state).st_mode & 0o777 == 0o666 & ~defaults.UMASK
+    os.chmod(state, 0o600)
+    save_high_water_marks(state, {"d": {"created_at": 4, "message_id": 4}})
+    assert os.stat(state).st_mode & 0o777 == 0o600
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_iter_channels_follows_next(engine, session):
+    # More chats than one page of group channels (100 of them): the listing follows next to the last page
+    with FakeSendbird(channels=250, messages=1) as fake:
+        endpoints.configure(fake.url)
+        if engine == "threads":
+            urls = [url for url, _ in iter_channels(KEY, session)]
+        else:
+            pytest.importorskip("aiohttp")
+            from reddit_chat_archiver import aio  # pylint: disable=import-outside-toplevel
+
+            async def channel_urls(key, session):
+                return [url async for url, _ in aio.iter_channels(key, session)]
+
+            urls = aio.run(channel_urls, KEY)
+        assert urls == [fake.channel_url(i) for i in range(250)]
@@ -0,0 +1,58 @@
+import concurrent.futures
+import json
+import os
+
+from reddit_chat_archiver import cache
+from reddit_chat_archiver.cache import ChannelCache, CredentialCache
+from reddit_chat_archiver.reddit_chat_archiver import get_all_channels
+
+from conftest import KEY
+
+
+def test_channel_cache(fake, session, tmp_path, monkeypatch):
+    path = str(tmp_path / "channels.json")
+    expected = get_all_channels(KEY, session)
+    assert ChannelCache(path).get_all_channels(KEY, session, account="t2_a") == expected
+    # Within the TTL: no request
+    requests = fake.requests
+    assert ChannelCache(path).get_all_channels(KEY, session, account="t2_a") == expected
+    assert fake.requests == requests
+    # Another account has its own entry
+    assert ChannelCache(path).get_all_channels(KEY, session, account="t2_b") == expected
+    assert fake.requests > requests
+    with open(path, encoding="utf-8") as f:
+        assert sorted(json.load(f)) == ["t2_a", "t2_b"]
+
+    # Past the TTL, the channels are listed again, but only the one that changed is derived again
+    derived = []
+
+    def channel_details(group_channel):
+        derived.append(group_channel)
+        return {"type": 1, "name": 1}
+
+    monkeypatch.setattr(cache, "channel_details", channel_details)
+    fake.live_message(1)
+    requests = fake.requests
+    channels = ChannelCache(path, ttl=0).get_all_channels(KEY, session, account="t2_a")
+    assert fake.requests > requests
+    assert [group_channel["channel_url"] for group_channel in derived] == [fake.channel_url(1)]
+    assert channels == dict(expected, **{fake.channel_url(1): {"type": 1, "name": 1}})
+
+
+def test_credential_cache(tmp_path):
+    path = str(tmp_path / "cache" / "credentials.json")
+    CredentialCache(path).put("user", "t2_user", "token", "key")
+    assert CredentialCache(path).get("user") == ("t2_user", "token", "key")
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    CredentialCache(path, ttl=-1).put("user", "t2_user", "token", "key")
+    assert CredentialCache(path).get("user") is None
+
+
+def test_write_private_json_concurrently(tmp_path):
+    # Other processes write the same cache: each write goes through its own temporary file
+    path = str(tmp_path / "cache" / "channels.json")
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda i: cache.write_private_json(path, {"i": i, "padding": "x" * 100000}), range(64)))
+    assert cache.read_json(path)["i"] in range(64)
+    assert os.listdir(tmp_path / "cache") == ["channels.json"]
+    assert os.stat(path).st_mode & 0o777 == 0o600
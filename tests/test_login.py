@@ -0,0 +1,62 @@
+import io
+
+import pytest
+
+from reddit_chat_archiver.cache import CredentialCache
+from reddit_chat_archiver.fake_server import REVOKED
+from reddit_chat_archiver.reddit_chat_archiver import (
+    ArchiverSession,
+    Chat,
+    StreamPipeline,
+    connect,
+    get_all_channels,
+    login,
+    relogin,
+    websocket_url,
+)
+
+from conftest import CHANNELS, KEY
+
+
+@pytest.mark.usefixtures("fake")
+def test_login_replaces_rejected_credentials(session, tmp_path):
+    credential_cache = CredentialCache(str(tmp_path / "credentials.json"))
+    credential_cache.put("user", "t2_user", "token", "revoked-key")
+    user_id, sb_access_token, key = login("user", "password", None, session, credential_cache)
+    assert REVOKED not in key
+    assert credential_cache.get("user") == (user_id, sb_access_token, key)
+    # Expired credentials are not even tried
+    CredentialCache(credential_cache.path, ttl=-1).put("user", "t2_user", "token", "expired-key")
+    assert login("user", "password", None, session, credential_cache)[2] != "expired-key"
+
+
+@pytest.mark.usefixtures("fake")
+def test_connect_keeps_the_key_off_the_session():
+    # The session also logs in to reddit again: the Sendbird Session-Key must not be sent there
+    session = ArchiverSession()
+    try:
+        key, all_channels = connect("user", "password", None, session)[2:]
+        assert "Session-Key" not in session.headers
+        assert all_channels == get_all_channels(key, ArchiverSession(key))
+    finally:
+        session.close()
+
+
+@pytest.mark.usefixtures("fake")
+def test_websocket_rejects_revoked_token():
+    # What makes stream() drop the cached credentials and log in again
+    chat = Chat(websocket_url("t2_user", "revoked-token"), {}, StreamPipeline({}, output=io.StringIO()))
+    chat.start()
+    assert chat.rejected
+
+
+@pytest.mark.usefixtures("fake")
+def test_relogin_replaces_rejected_token(session, tmp_path):
+    # The cached Session-Key still works, so only the websocket finds out that the access token doesn't: both are replaced
+    credential_cache = CredentialCache(str(tmp_path / "credentials.json"))
+    credential_cache.put("user", "t2_user", "revoked-token", KEY)
+    assert connect("user", "password", None, session, credential_cache=credential_cache)[1] == "revoked-token"
+    user_id, sb_access_token, key, all_channels = relogin("user", "password", None, session, credential_cache=credential_cache)
+    assert REVOKED not in sb_access_token
+    assert credential_cache.get("user") == (user_id, sb_access_token, key)
+    assert len(all_channels) == CHANNELS
@@ -0,0 +1,29 @@
+import os
+import time
+
+from reddit_chat_archiver import defaults, metrics
+
+
+def test_metrics_recent_latencies(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "QUANTILE_WINDOW", 0.1)
+    recorder = metrics.Metrics()
+    recorder.enable()
+    url = "http://127.0.0.1/v3/group_channels"
+    recorder.request(url, 200, 5.0)
+    assert recorder.recent_latencies() == {"group_channels": [5.0]}
+    time.sleep(0.2)
+    recorder.request(url, 200, 0.5)
+    recorder.request(url, 200, 0.25)
+    assert recorder.recent_latencies() == {"group_channels": [0.25, 0.5]}
+    path = str(tmp_path / "metrics.prom")
+    recorder.write(path)
+    assert os.listdir(str(tmp_path)) == ["metrics.prom"]
+    # Readable by whoever scrapes it, as a file created without a temporary one would be
+    assert os.stat(path).st_mode & 0o777 == 0o666 & ~defaults.UMASK
+    os.chmod(path, 0o640)
+    recorder.write(path)
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    assert 'reddit_chat_archiver_request_seconds_recent{endpoint="group_channels",quantile="0.95"} 0.5\n' in text
+    assert 'reddit_chat_archiver_request_seconds_count{endpoint="group_channels"} 3\n' in text
@@ -0,0 +1,30 @@
+import pytest
+
+from reddit_chat_archiver import ratelimit
+from reddit_chat_archiver.ratelimit import RateLimiter
+
+
+def test_rate_limiter(monkeypatch):
+    limiter = RateLimiter(max_rate=8)
+    limiter.throttled()
+    assert limiter.rate == 4
+    # A 429 of a request sent before the rate was lowered doesn't lower it again
+    limiter.throttled()
+    assert limiter.rate == 4
+    monkeypatch.setattr(ratelimit, "DECREASE_COOLDOWN", 0)
+    limiter.throttled()
+    assert limiter.rate == 2
+    limiter.succeeded()
+    assert limiter.rate == pytest.approx(2 + 8 * ratelimit.INCREASE)
+    limiter.throttled(retry_after=5)
+    assert limiter.reserve() > 4.9
+
+
+def test_rate_limiter_without_max_rate():
+    # Not limited until throttled, then limited to half of what was sent
+    limiter = RateLimiter()
+    for _ in range(10):
+        assert limiter.reserve() == 0
+    assert limiter.rate is None
+    limiter.throttled()
+    assert limiter.rate >= ratelimit.MIN_RATE
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from reddit_chat_archiver.fake_server import FakeSendbird
+from reddit_chat_archiver.reddit_chat_archiver import ArchiverSession
+from reddit_chat_archiver.ratelimit import RateLimiter
+from reddit_chat_archiver.retry import RetryPolicy
+
+from conftest import KEY, MESSAGES
+
+
+def fast_retries(max_attempts=3):
+    return RetryPolicy(max_attempts=max_attempts, backoff=0.001)
+
+
+def test_session_retries_errors():
+    with FakeSendbird(channels=1, messages=MESSAGES, error_rate=0.9) as fake:
+        session = ArchiverSession(KEY, rate_limiter=RateLimiter(), retry_policy=fast_retries(20))
+        uri = f"{fake.url}/v3/group_channels/{fake.channel_url(0)}/messages"
+        assert session.get(uri, params={"message_ts": "0"}).status_code == 200
+        assert fake.requests > 1
+        session.close()
+
+
+def test_session_gives_up():
+    with FakeSendbird(channels=1, messages=1, error_rate=1.0) as fake:
+        session = ArchiverSession(KEY, rate_limiter=RateLimiter(), retry_policy=fast_retries())
+        assert session.get(f"{fake.url}/v3/group_channels").status_code in (500, 503)
+        assert fake.requests == 3
+        # Requests that change something are never retried
+        assert session.post(f"{fake.url}/post/login").status_code in (500, 503)
+        assert fake.requests == 4
+        session.close()
+
+
+def test_session_retries_throttled():
+    with FakeSendbird(channels=1, messages=1, throttle_rate=1.0, retry_after=0) as fake:
+        limiter = RateLimiter(max_rate=1000)
+        session = ArchiverSession(KEY, rate_limiter=limiter, retry_policy=fast_retries())
+        assert session.get(f"{fake.url}/v3/group_channels").status_code == 429
+        assert fake.requests == 3
+        assert limiter.rate < 1000
+        session.close()
+
+
+def test_aio_get_json_retries():
+    aiohttp = pytest.importorskip("aiohttp")
+    from reddit_chat_archiver import aio  # pylint: disable=import-outside-toplevel
+
+    async def get(fake, limiter):
+        async with aio.make_session(KEY) as session:
+            return await aio.get_json(session, f"{fake.url}/v3/group_channels", rate_limiter=limiter, retry_policy=fast_retries())
+
+    with FakeSendbird(channels=2, messages=1, throttle_rate=1.0, retry_after=0) as fake:
+        limiter = RateLimiter(max_rate=1000)
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            asyncio.run(get(fake, limiter))
+        assert error.value.status == 429
+        assert fake.requests == 3
+        assert limiter.rate < 1000
+    with FakeSendbird(channels=2, messages=1, error_rate=0.5) as fake:
+        assert len(asyncio.run(get(fake, RateLimiter()))["channels"]) == 2
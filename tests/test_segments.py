@@ -0,0 +1,67 @@
+import ast
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from reddit_chat_archiver import defaults, segments
+
+from conftest import message_ids
+
+
+def segment_messages(channel, count, start=0):
+    return [{"message_id": i, "channel_url": channel, "created_at": 1000 * i, "message": str(i)} for i in range(start, count)]
+
+
+def test_read_range(tmp_path):
+    root = str(tmp_path)
+    url = "sendbird_group_channel_0"
+    sink = segments.SegmentSink(root, segment_size=10)
+    sink.start_channel(url)
+    messages = segment_messages(url, 35)
+    for i in range(0, 35, 7):
+        sink.write_page(url, messages[i : i + 7])
+    sink.close()
+    assert len(segments.load_index(root, url)["segments"]) == 4
+    # The index is replaced through a temporary file of its own, which doesn't stay behind
+    assert not [name for name in os.listdir(segments.channel_dir(root, url)) if name.endswith(".tmp")]
+    assert os.stat(os.path.join(segments.channel_dir(root, url), segments.INDEX)).st_mode & 0o777 == 0o666 & ~defaults.UMASK
+    assert list(segments.read_range(root, url)) == messages
+    assert list(segments.read_range(root, url, since=12000, until=25000)) == messages[12:25]
+    assert not list(segments.read_range(root, url, since=40000))
+    with pytest.raises(FileNotFoundError):
+        list(segments.read_range(root, "sendbird_group_channel_1"))
+
+
+def test_read_range_of_open_segment(tmp_path):
+    # Like a run that was killed: the last segment is never closed, and the next run doesn't overwrite it
+    root = str(tmp_path)
+    url = "sendbird_group_channel_0"
+    killed = segments.SegmentSink(root, segment_size=10)
+    killed.start_channel(url)
+    killed.write_page(url, segment_messages(url, 15))
+    assert message_ids(segments.read_range(root, url)) == list(range(15))
+
+    sink = segments.SegmentSink(root, segment_size=10)
+    sink.start_channel(url, append=True)
+    sink.write_page(url, segment_messages(url, 20, start=15))
+    sink.close()
+    assert message_ids(segments.read_range(root, url)) == list(range(20))
+
+
+def test_read_segments_command(tmp_path):
+    # An offline command: it runs without importing the archiver or its network libraries
+    root = str(tmp_path)
+    url = "sendbird_group_channel_0"
+    sink = segments.SegmentSink(root, segment_size=10)
+    sink.start_channel(url)
+    sink.write_page(url, segment_messages(url, 15))
+    sink.close()
+    code = "import sys; from reddit_chat_archiver.cli import main; main(sys.argv[1:]); print(sorted(sys.modules), file=sys.stderr)"
+    command = [sys.executable, "-c", code, "read-segments", root, url, "-f", "jsonl", "--since", "5000"]
+    result = subprocess.run(command, check=True, capture_output=True, text=True)
+    assert [json.loads(line)["message_id"] for line in result.stdout.splitlines()] == list(range(5, 15))
+    modules = set(ast.literal_eval(result.stderr.splitlines()[-1]))
+    assert not modules & {"requests", "websocket", "reddit_chat_archiver.reddit_chat_archiver"}
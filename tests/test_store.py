@@ -0,0 +1,110 @@
+import os
+import sqlite3
+
+import pytest
+
+from reddit_chat_archiver import store as store_module
+from reddit_chat_archiver.cli import main
+from reddit_chat_archiver.fake_server import MESSAGE_STEP
+from reddit_chat_archiver.reddit_chat_archiver import archive_all, get_all_channels
+from reddit_chat_archiver.store import SqliteStore, search_query
+
+from conftest import CHANNELS, KEY
+
+
+@pytest.fixture(name="database")
+def fixture_database(fake, session, tmp_path):  # pylint: disable=unused-argument
+    path = str(tmp_path / "archive.sqlite")
+    store = SqliteStore(path)
+    try:
+        archive_all(KEY, get_all_channels(KEY, session), sink=store, jobs=2, session=session)
+    finally:
+        store.close()
+    return path
+
+
+def test_search(database, capsys):
+    store = SqliteStore(database, readonly=True)
+    try:
+        assert [row[0] for row in store.search('"message 7 of chat 2"')] == [2 * 10**9 + 7]
+        assert [row[0] for row in store.search('"of chat 1"', order="oldest", limit=2)] == [10**9, 10**9 + 1]
+        assert not store.search('"message 7 of chat 2"', channel="Fake chat 1")
+    finally:
+        store.close()
+    main(["search", database, '"message 17 of chat 0"', "-n", "1"])
+    assert "message 17 of chat 0" in capsys.readouterr().out
+
+
+def test_search_time_range(fake, database):
+    since, until = fake.first_created_at + 100 * MESSAGE_STEP, fake.first_created_at + 103 * MESSAGE_STEP
+    store = SqliteStore(database, readonly=True)
+    try:
+        assert [row[0] for row in store.search('"of chat 1"', since=since, until=until, order="oldest")] == [
+            10**9 + i for i in range(100, 103)
+        ]
+        assert sorted(row[0] for row in store.search("message", since=since, until=until)) == [
+            channel * 10**9 + i for channel in range(CHANNELS) for i in range(100, 103)
+        ]
+    finally:
+        store.close()
+
+
+@pytest.fixture(name="interleaved")
+def fixture_interleaved(tmp_path):
+    # Two chats whose message_ids and created_at interleave in opposite ways: chat a has the larger ids, chat b the later
+    # messages. Enough of them match "word" to take the SEARCH_BY_TIME path.
+    path = str(tmp_path / "interleaved.sqlite")
+    store = SqliteStore(path)
+    messages = [
+        {"message_id": 10**6 + i, "channel_url": "a", "type": "MESG", "created_at": 10 * i, "message": "word a%d" % i}
+        for i in range(store_module.SCAN_MATCHES)
+    ] + [
+        {"message_id": i, "channel_url": "b", "type": "MESG", "created_at": 10 * i + 5, "message": "word b%d" % i}
+        for i in range(store_module.SCAN_MATCHES)
+    ]
+    try:
+        store.write_page(None, messages)
+    finally:
+        store.close()
+    by_time = sorted(messages, key=lambda message: message["created_at"])
+    return path, [message["message_id"] for message in by_time], [message["created_at"] for message in by_time]
+
+
+@pytest.mark.parametrize("scan_matches", [1, 10**9])
+def test_search_interleaved_ids(interleaved, monkeypatch, scan_matches):
+    # Both with and without SEARCH_BY_TIME, the results are ordered and filtered by created_at, never by message_id
+    monkeypatch.setattr(store_module, "SCAN_MATCHES", scan_matches)
+    path, ids, times = interleaved
+    store = SqliteStore(path, readonly=True)
+    try:
+        assert [row[0] for row in store.search("word", limit=5)] == ids[::-1][:5]
+        assert [row[0] for row in store.search("word", order="oldest", limit=5)] == ids[:5]
+        since, until = times[100], times[900]
+        assert [row[0] for row in store.search("word", since=since, until=until, order="oldest", limit=10**6)] == ids[100:900]
+        assert [row[0] for row in store.search("word", since=since, limit=10**6)] == ids[100:][::-1]
+    finally:
+        store.close()
+
+
+def test_search_plan(interleaved):
+    # With many matches, newest and oldest walk the created_at index and stop at the limit, instead of sorting every match
+    db = sqlite3.connect(interleaved[0])
+    try:
+        for order in ["newest", "oldest"]:
+            sql, params = search_query("word", channel="b", since=0, until=2**40, order=order, by_time=True)
+            plan = " ".join(row[-1] for row in db.execute("EXPLAIN QUERY PLAN " + sql, params))
+            assert "messages_created_at" in plan
+            assert "TEMP B-TREE" not in plan
+    finally:
+        db.close()
+
+
+def test_search_errors(database, tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        main(["search", database, "'unbalanced"])
+    assert "cannot search" in capsys.readouterr().err
+    missing = str(tmp_path / "missing.sqlite")
+    with pytest.raises(SystemExit):
+        main(["search", missing, "message"])
+    assert "no such database" in capsys.readouterr().err
+    assert not os.path.exists(missing)
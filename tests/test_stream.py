@@ -0,0 +1,116 @@
+import asyncio
+import io
+import json
+import time
+
+import pytest
+
+from reddit_chat_archiver import endpoints, reddit_chat_archiver
+from reddit_chat_archiver.fake_server import FakeSendbird
+from reddit_chat_archiver.reddit_chat_archiver import StreamPipeline
+
+from conftest import RecordingSink, message_ids
+
+
+def test_stream_pipeline_reconnects(tmp_path):
+    aiohttp = pytest.importorskip("aiohttp")
+    from reddit_chat_archiver import aio  # pylint: disable=import-outside-toplevel
+
+    # Each connection gets a burst of 10 messages but is dropped after 3 of them: the other 7 come from the backfill that
+    # follows the reconnect
+    with FakeSendbird(channels=1, messages=5, burst=10, drop_after=4) as fake:
+        endpoints.configure(fake.url)
+        url = fake.channel_url(0)
+        sink = RecordingSink()
+        pipeline = StreamPipeline({}, output=io.StringIO(), sink=sink, state=str(tmp_path / "state.json"))
+
+        async def stream():
+            async with aiohttp.ClientSession() as session:
+                task = asyncio.ensure_future(aio.stream_account({"username": "user", "password": "password"}, pipeline, session))
+                deadline = time.monotonic() + 10
+                while time.monotonic() < deadline and len(sink.messages.get(url, [])) < 20:
+                    await asyncio.sleep(0.05)
+                task.cancel()
+
+        pipeline.start()
+        try:
+            asyncio.run(stream())
+        finally:
+            pipeline.stop()
+
+    # From the first message received live on, nothing is missing, duplicated or out of order
+    archived = message_ids(sink.messages[url])
+    assert len(archived) >= 20
+    assert archived == list(range(archived[0], archived[0] + len(archived)))
+    with open(str(tmp_path / "state.json"), encoding="utf-8") as f:
+        assert json.load(f)[url]["message_id"] == archived[-1]
+
+
+class FlakySink(RecordingSink):
+    # Fails the first write of fail_channel, and records how many chats were started at once
+    def __init__(self, fail_channel=None):
+        super().__init__()
+        self.started = set()
+        self.most_started = 0
+        self.fail_channel = fail_channel
+
+    def start_channel(self, channel_url, append=False):
+        assert channel_url not in self.started
+        self.started.add(channel_url)
+        self.most_started = max(self.most_started, len(self.started))
+
+    def write_page(self, channel_url, messages):
+        assert channel_url in self.started
+        if channel_url == self.fail_channel:
+            self.fail_channel = None
+            raise OSError(24, "Too many open files")
+        super().write_page(channel_url, messages)
+
+    def finish_channel(self, channel_url):
+        self.started.remove(channel_url)
+
+
+def mesg_frame(channel_url, message_id):
+    return "MESG" + json.dumps({"msg_id": message_id, "ts": 1000 * message_id, "channel_url": channel_url, "message": "hi"})
+
+
+def test_stream_pipeline_sink_files(tmp_path):
+    # Only a few chats are kept open, and a page that failed is written with the next batch, before the chat's mark moves
+    urls = ["sendbird_group_channel_%d" % i for i in range(20)]
+    sink = FlakySink(fail_channel=urls[3])
+    state = str(tmp_path / "state.json")
+    pipeline = StreamPipeline(
+        {url: {"type": None, "name": url} for url in urls},
+        output=io.StringIO(),
+        sink=sink,
+        state=state,
+        batch_size=10,
+        open_channels=4,
+    )
+    pipeline.start()
+    for i in range(100):
+        pipeline.feed(mesg_frame(urls[i % len(urls)], i))
+    pipeline.stop()
+    assert sink.most_started == 4
+    assert not sink.started
+    assert {url: message_ids(messages) for url, messages in sink.messages.items()} == {
+        url: list(range(i, 100, len(urls))) for i, url in enumerate(urls)
+    }
+    with open(state, encoding="utf-8") as f:
+        assert {url: mark["message_id"] for url, mark in json.load(f).items()} == {url: 80 + i for i, url in enumerate(urls)}
+
+
+def test_stream_pipeline_unknown_channel(monkeypatch):
+    # A lookup that fails in any way still releases the chat's messages, under the chat's URL
+    monkeypatch.setattr(reddit_chat_archiver, "get_channel", lambda key, channel_url, session=None: None)
+    sink = RecordingSink()
+    pipeline = StreamPipeline({}, output=io.StringIO(), sink=sink)
+    pipeline.start()
+    try:
+        pipeline.feed(mesg_frame("sendbird_group_channel_new", 1))
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and not sink.messages:
+            time.sleep(0.01)
+        assert message_ids(sink.messages["sendbird_group_channel_new"]) == [1]
+    finally:
+        pipeline.stop()
@@ -0,0 +1,25 @@
+import json
+import os
+
+from reddit_chat_archiver.tracing import Tracer
+
+
+def test_tracer(tmp_path):
+    path = str(tmp_path / "trace.json")
+    tracer = Tracer()
+    with tracer.span("disabled"):
+        pass
+    tracer.enable(path)
+    with tracer.span("page", "page", channel="c") as args:
+        args["messages"] = 3
+    for _ in range(1000):
+        tracer.complete("decode", 0, 0, "json")
+    # Written as it goes, not kept in memory until the end
+    assert os.path.getsize(path) > 0
+    tracer.close()
+    with tracer.span("closed"):
+        pass
+    with open(path, encoding="utf-8") as f:
+        events = json.load(f)
+    assert [event["name"] for event in events if event["ph"] == "X"] == ["page"] + ["decode"] * 1000
+    assert events[1]["args"] == {"channel": "c", "messages": 3}